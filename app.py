@@ -634,12 +634,16 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
 from backend import (
-    load_data, compute_balances,
-    add_payment, add_borrower,
-    save_borrowers, save_payments,
-    monthly_summary, get_payment_history,
+    get_storage, load_versioned_data, compute_balances,
+    get_data_cache, refresh_data, money_to_rm,
+    register_borrower, record_payment, reverse_payment, get_payment_writer, get_payment_totals,
+    reconcile_balances, drop_stored_balances,
+    monthly_summary, get_payment_history, get_payment_index, get_borrower_lookup,
+    get_schedule, schedule_for, compute_arrears, aging_summary, get_collections_cube,
+    get_balance_series, monthly_balance_series, get_cash_flow_forecast, get_portfolio_simulation,
     calculate_payment_schedule, get_dashboard_stats
 )
+from storage import memory_report
 
 # Configuration
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1pS0OCxO8tg85gVdOz8XeVw_WAvmXeVLHGHWompwFPjo/edit"
@@ -675,6 +679,8 @@ LANGUAGES = {
         'submit': 'Submit',
         'create': 'Create',
         'select': 'Select',
+        'search': 'Search name, phone or department',
+        'no_match': 'No matching borrowers',
         'loan': 'Loan',
         'status': 'Status',
         'progress': 'Progress',
@@ -702,7 +708,33 @@ LANGUAGES = {
         'enter_amount': 'Enter amount',
         'full_name': 'Full Name',
         'total_payments': 'Total Payments',
-        'new_balance': 'New Balance'
+        'new_balance': 'New Balance',
+        'trend': 'Trend',
+        'forecast': 'Cash-flow Forecast',
+        'on_time_weighted': 'Weight by on-time payment rate',
+        'simulation': 'What-if Simulation',
+        'simulations': 'Simulations',
+        'seed': 'Seed',
+        'run': 'Run',
+        'interest_collected': 'Interest collected',
+        'principal_outstanding': 'Principal outstanding',
+        'arrears': 'Arrears',
+        'as_of': 'As of',
+        'overdue': 'Overdue',
+        'days_past_due': 'Days Past Due',
+        'aging': 'Aging',
+        'queued': 'payment(s) waiting to sync',
+        'memory': 'Memory use',
+        'updated': 'Updated',
+        'ago': 'ago',
+        'reconciliation': 'Stored Balance Check',
+        'stored': 'Stored',
+        'computed': 'Computed',
+        'difference': 'Difference',
+        'balances_match': 'Stored balances match the payments',
+        'drop_stored': 'Remove stored balance columns',
+        'reverse': 'Reverse',
+        'reverse_payment': 'Reverse a payment'
     },
     'Malay': {
         'title': 'Sistem Pengurusan Pinjaman',
@@ -733,6 +765,8 @@ LANGUAGES = {
         'submit': 'Hantar',
         'create': 'Cipta',
         'select': 'Pilih',
+        'search': 'Cari nama, telefon atau jabatan',
+        'no_match': 'Tiada peminjam yang sepadan',
         'loan': 'Pinjaman',
         'status': 'Status',
         'progress': 'Kemajuan',
@@ -760,7 +794,33 @@ LANGUAGES = {
         'enter_amount': 'Masukkan jumlah',
         'full_name': 'Nama Penuh',
         'total_payments': 'Jumlah Bayaran',
-        'new_balance': 'Baki Baru'
+        'new_balance': 'Baki Baru',
+        'trend': 'Trend',
+        'forecast': 'Ramalan Aliran Tunai',
+        'on_time_weighted': 'Ikut kadar bayaran tepat masa',
+        'simulation': 'Simulasi Senario',
+        'simulations': 'Simulasi',
+        'seed': 'Benih',
+        'run': 'Jalankan',
+        'interest_collected': 'Bunga dikutip',
+        'principal_outstanding': 'Pokok belum bayar',
+        'arrears': 'Tunggakan',
+        'as_of': 'Setakat',
+        'overdue': 'Tertunggak',
+        'days_past_due': 'Hari Lewat',
+        'aging': 'Tempoh',
+        'queued': 'bayaran menunggu untuk disegerakkan',
+        'memory': 'Penggunaan memori',
+        'updated': 'Dikemas kini',
+        'ago': 'lalu',
+        'reconciliation': 'Semakan Baki Tersimpan',
+        'stored': 'Tersimpan',
+        'computed': 'Dikira',
+        'difference': 'Perbezaan',
+        'balances_match': 'Baki tersimpan sepadan dengan bayaran',
+        'drop_stored': 'Buang lajur baki tersimpan',
+        'reverse': 'Batalkan',
+        'reverse_payment': 'Batalkan bayaran'
     },
     'Tamil': {
         'title': 'கடன் மேலாண்மை அமைப்பு',
@@ -791,6 +851,8 @@ LANGUAGES = {
         'submit': 'சமர்ப்பிக்க',
         'create': 'உருவாக்கு',
         'select': 'தேர்வு செய்',
+        'search': 'பெயர், தொலைபேசி அல்லது துறையைத் தேடு',
+        'no_match': 'பொருந்தும் கடன் வாங்குபவர்கள் இல்லை',
         'loan': 'கடன்',
         'status': 'நிலை',
         'progress': 'முன்னேற்றம்',
@@ -818,7 +880,33 @@ LANGUAGES = {
         'enter_amount': 'தொகையை உள்ளிடவும்',
         'full_name': 'முழு பெயர்',
         'total_payments': 'மொத்த பணம்',
-        'new_balance': 'புதிய இருப்பு'
+        'new_balance': 'புதிய இருப்பு',
+        'trend': 'போக்கு',
+        'forecast': 'பணப்புழக்க முன்னறிவிப்பு',
+        'on_time_weighted': 'சரியான நேர செலுத்துதல் விகிதப்படி',
+        'simulation': 'சூழ்நிலை உருவகப்படுத்தல்',
+        'simulations': 'உருவகப்படுத்தல்கள்',
+        'seed': 'விதை',
+        'run': 'இயக்கு',
+        'interest_collected': 'வசூலான வட்டி',
+        'principal_outstanding': 'நிலுவை அசல்',
+        'arrears': 'நிலுவை',
+        'as_of': 'தேதியின்படி',
+        'overdue': 'தாமதமானது',
+        'days_past_due': 'தாமத நாட்கள்',
+        'aging': 'காலம்',
+        'queued': 'கட்டணங்கள் ஒத்திசைக்க காத்திருக்கின்றன',
+        'memory': 'நினைவக பயன்பாடு',
+        'updated': 'புதுப்பிக்கப்பட்டது',
+        'ago': 'முன்பு',
+        'reconciliation': 'சேமித்த மீதச் சரிபார்ப்பு',
+        'stored': 'சேமித்தது',
+        'computed': 'கணக்கிட்டது',
+        'difference': 'வேறுபாடு',
+        'balances_match': 'சேமித்த மீதங்கள் கட்டணங்களுடன் பொருந்துகின்றன',
+        'drop_stored': 'சேமித்த மீத நெடுவரிசைகளை நீக்கு',
+        'reverse': 'ரத்து செய்',
+        'reverse_payment': 'கட்டணத்தை ரத்து செய்'
     }
 }
 
@@ -927,13 +1015,12 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Load data
-@st.cache_data(ttl=60)
-def load_app_data():
-    return load_data(SHEET_URL)
-
-borrowers, payments, borrowers_ws, payments_ws = load_app_data()
-borrowers = compute_balances(borrowers, payments)
+# Load data (served from the shared cache, refreshed in the background)
+store = get_storage(SHEET_URL)
+data_cache = get_data_cache(SHEET_URL)
+borrowers, payments, data_info = load_versioned_data(SHEET_URL)
+borrowers = compute_balances(borrowers, payments, get_payment_totals(payments, data_info["versions"].get("payments")))
+lookup = get_borrower_lookup(borrowers, data_info["version"])
 
 # Sidebar with language selector
 with st.sidebar:
@@ -960,8 +1047,28 @@ with st.sidebar:
     
     # Refresh button
     if st.button(f"🔄 {t['refresh']}", use_container_width=True):
-        st.cache_data.clear()
-        st.rerun()
+        if refresh_data(SHEET_URL):
+            st.rerun()
+    
+    # Data age
+    data_age = data_cache.age()
+    if data_age is not None:
+        age_text = f"{int(data_age)}s" if data_age < 120 else f"{int(data_age // 60)} min"
+        st.caption(f"🕒 {t['updated']} {age_text} {t['ago']}")
+    if data_cache.last_error:
+        st.caption(f"⚠️ {data_cache.last_error}")
+    writer_status = get_payment_writer(store).status()
+    if writer_status["pending"]:
+        st.caption(f"⏳ {writer_status['pending']} {t['queued']}")
+    if writer_status["last_error"]:
+        st.caption(f"⚠️ {writer_status['last_error']}")
+    
+    # Per-column dtype and memory of the shared frames
+    with st.expander(f"🧮 {t['memory']}"):
+        for label, frame in (("borrowers", borrowers), ("payments", payments)):
+            report = memory_report(frame)
+            st.caption(f"{label}: {report['bytes'].sum() / 1024:,.1f} KB")
+            st.dataframe(report, use_container_width=True)
 
 # Main header
 st.markdown(f'<h1 class="main-header">💰 {t["title"]}</h1>', unsafe_allow_html=True)
@@ -1009,7 +1116,7 @@ with tab1:
     # Charts - stack on mobile
     st.subheader(f"{t['outstanding']} {t['balance']}")
     if not borrowers.empty:
-        chart_data = borrowers[borrowers['principal_remaining'] > 0].copy()
+        chart_data = money_to_rm(borrowers[borrowers['principal_remaining'] > 0])
         chart_data['total_remaining'] = chart_data['principal_remaining'] + chart_data['interest_remaining']
         chart_data = chart_data.sort_values('total_remaining', ascending=True).tail(10)
         
@@ -1025,11 +1132,24 @@ with tab1:
         fig.update_layout(showlegend=False, height=400, margin=dict(l=20, r=20, t=40, b=20))
         st.plotly_chart(fig, use_container_width=True)
     
+    # Outstanding balance history, month by month
+    series = monthly_balance_series(get_balance_series(SHEET_URL, borrowers, payments, data_info["version"]))
+    if not series.empty:
+        st.subheader(f"📉 {t['outstanding']} {t['trend']}")
+        trend = pd.DataFrame({
+            t['principal']: series['principal_outstanding'] / 100,
+            t['interest']: series['interest_outstanding'] / 100
+        }, index=series.index)
+        fig = px.line(trend, labels={'index': t['month'], 'value': f'{t["amount"]} (RM)', 'variable': ''})
+        fig.update_layout(height=350, margin=dict(l=20, r=20, t=40, b=20))
+        st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"{t['collection_rate']}: {series['collection_rate'].iloc[-1]:.1f}%")
+    
     # Active borrowers table
     st.markdown("---")
     st.subheader(f"{t['active']} {t['loan']}")
     if not borrowers.empty:
-        active = borrowers[borrowers['principal_remaining'] > 0].copy()
+        active = money_to_rm(borrowers[borrowers['principal_remaining'] > 0])
         active['total_remaining'] = active['principal_remaining'] + active['interest_remaining']
         active['progress'] = ((active['principal_total'] - active['principal_remaining']) / active['principal_total'] * 100).round(1)
         
@@ -1053,9 +1173,14 @@ with tab1:
 # ============= BORROWER DETAILS TAB =============
 with tab2:
     if not borrowers.empty:
-        selected = st.selectbox(f"🔍 {t['select']} {t['name']}", borrowers["name"].tolist(), key="borrower_select")
+        query = st.text_input(f"🔍 {t['search']}", key="borrower_search")
+        matches = lookup.search(query)
+        if not matches:
+            st.info(t['no_match'])
+            matches = lookup.search("")
+        selected = st.selectbox(f"{t['select']} {t['name']}", matches, key="borrower_select")
         
-        b = borrowers[borrowers["name"] == selected].iloc[0]
+        b = money_to_rm(lookup.select(borrowers, selected)).iloc[0]
         
         # Borrower info - stack on mobile
         st.markdown("---")
@@ -1068,7 +1193,8 @@ with tab2:
             st.write(f"**{t['department']}:** {b['department']}")
         with col2:
             st.write(f"**{t['phone']}:** {b['phone']}")
-            st.write(f"**{t['start_date']}:** {b['loan_start_date']}")
+            start = b['loan_start_date']
+            st.write(f"**{t['start_date']}:** {start.strftime('%Y-%m-%d') if pd.notna(start) else '-'}")
         
         st.markdown("---")
         
@@ -1086,6 +1212,21 @@ with tab2:
         st.progress(progress / 100)
         st.write(f"**{t['progress']}:** {progress:.1f}%")
         
+        with st.expander(f"📅 {t['schedule']}"):
+            schedule = get_schedule(borrowers, data_info["versions"].get("borrowers"))
+            plan = money_to_rm(schedule_for(schedule, b['borrower_id']), ("principal_due", "interest_due", "total_due"))
+            plan_display = plan[['installment', 'due_date', 'principal_due', 'interest_due', 'total_due']].copy()
+            plan_display['due_date'] = plan_display['due_date'].dt.strftime('%Y-%m-%d')
+            plan_display.columns = [t['month'], t['date'], t['principal'], t['interest'], t['total']]
+            st.dataframe(
+                plan_display.style.format({
+                    t['principal']: 'RM {:,.2f}',
+                    t['interest']: 'RM {:,.2f}',
+                    t['total']: 'RM {:,.2f}'
+                }),
+                use_container_width=True
+            )
+        
         st.markdown("---")
         
         # Outstanding balance
@@ -1106,7 +1247,8 @@ with tab2:
         st.markdown("---")
         st.subheader(f"💳 {t['payment_history']}")
         
-        history = get_payment_history(b['borrower_id'], payments)
+        payment_index = get_payment_index(payments, data_info["versions"].get("payments"))
+        history = money_to_rm(get_payment_history(b['borrower_id'], payments, payment_index))
         if not history.empty:
             history_display = history[['date', 'principal_paid', 'interest_paid', 'total_paid']].copy()
             history_display.columns = [t['date'], t['principal'], t['interest'], t['total']]
@@ -1123,11 +1265,27 @@ with tab2:
             
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric(f"{t['total']} {t['payment']}", len(history))
+                st.metric(f"{t['total']} {t['payment']}", int(history['reverses'].isna().sum()))
             with col2:
                 st.metric(f"{t['principal']} {t['paid']}", f"RM {history['principal_paid'].sum():,.2f}")
             with col3:
                 st.metric(f"{t['interest']} {t['paid']}", f"RM {history['interest_paid'].sum():,.2f}")
+            
+            # Payments are never edited; a mistake is undone with a reversal entry
+            reversible = history[history['reverses'].isna() & ~history['payment_id'].isin(history['reverses'].dropna())]
+            if not reversible.empty:
+                labels = {
+                    row['payment_id']: f"#{row['payment_id']} · {row['date'].strftime('%Y-%m-%d') if pd.notna(row['date']) else '-'} · RM {row['total_paid']:,.2f}"
+                    for _, row in reversible.iterrows()
+                }
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    reverse_id = st.selectbox(t['reverse_payment'], list(labels), format_func=labels.get, key="reverse_payment_id")
+                with col2:
+                    st.write("")
+                    if st.button(f"↩️ {t['reverse']}", key="reverse_payment", use_container_width=True):
+                        if reverse_payment(SHEET_URL, store, int(reverse_id)):
+                            st.rerun()
         else:
             st.info(t['no_data'])
     else:
@@ -1182,31 +1340,32 @@ with tab3:
             elif principal <= 0:
                 st.error(f"{t['error']}: {t['principal']}")
             else:
-                borrowers = add_borrower(
-                    borrowers, name, dept, phone, principal, 
+                if register_borrower(
+                    SHEET_URL, store, name, dept, phone, principal,
                     interest_rate/100, start_date, months
-                )
-                if save_borrowers(borrowers, borrowers_ws):
+                ):
                     st.success(f"✅ {t['success']}!")
                     st.balloons()
-                    st.cache_data.clear()
 
 # ============= RECORD PAYMENT TAB =============
 with tab4:
     st.subheader(f"💳 {t['record']} {t['payment']}")
     
     if not borrowers.empty:
-        active_borrowers = borrowers[borrowers['principal_remaining'] > 0]
+        query = st.text_input(f"🔍 {t['search']}", key="payment_borrower_search")
+        matches = lookup.search(query, active_only=True)
         
-        if not active_borrowers.empty:
+        if lookup.active_labels and not matches:
+            st.info(t['no_match'])
+        elif lookup.active_labels:
             with st.form("payment_form"):
                 selected = st.selectbox(
                     f"{t['select']} {t['name']} *",
-                    active_borrowers["name"].tolist(),
+                    matches,
                     key="payment_borrower_select"
                 )
                 
-                b = active_borrowers[active_borrowers["name"] == selected].iloc[0]
+                b = money_to_rm(lookup.select(borrowers, selected)).iloc[0]
                 
                 # Current balance
                 st.markdown(f"##### {t['balance']} {t['remaining']}")
@@ -1258,14 +1417,8 @@ with tab4:
                     if total_payment == 0:
                         st.error(f"{t['error']}: {t['enter_amount']}")
                     else:
-                        payments = add_payment(
-                            b["borrower_id"], principal_pay, interest_pay, payments
-                        )
-                        borrowers = compute_balances(borrowers, payments)
-                        
-                        if save_borrowers(borrowers, borrowers_ws) and save_payments(payments, payments_ws):
+                        if record_payment(SHEET_URL, store, b["borrower_id"], principal_pay, interest_pay):
                             st.success(f"✅ {t['success']}! RM {total_payment:,.2f}")
-                            st.cache_data.clear()
                             st.balloons()
         else:
             st.info(f"🎉 {t['fully_paid']}!")
@@ -1274,15 +1427,22 @@ with tab4:
 
 # ============= REPORTS TAB =============
 with tab5:
+    report_tab, simulation_tab = st.tabs([f"📈 {t['monthly_report']}", f"🎲 {t['simulation']}"])
+
+with report_tab:
     st.subheader(f"📈 {t['monthly_report']}")
     
+    cube = get_collections_cube(payments, borrowers, data_info["version"])
+    years = cube.years() or [datetime.now().year]
+    
     col1, col2 = st.columns([1, 1])
-    with col1:
-        month = st.selectbox(t['month'], list(range(1, 13)), index=datetime.now().month - 1)
     with col2:
-        year = st.selectbox(t['year'], [2023, 2024, 2025, 2026], index=1)
+        year = st.selectbox(t['year'], years, index=len(years) - 1)
+    with col1:
+        months = cube.months_of(year) or [datetime.now().month]
+        month = st.selectbox(t['month'], months, index=len(months) - 1)
     
-    result = monthly_summary(payments, borrowers, month, year)
+    result = monthly_summary(payments, borrowers, month, year, cube)
     
     # Monthly metrics
     st.markdown("---")
@@ -1298,6 +1458,18 @@ with tab5:
         st.metric(f"{t['principal']} {t['collected']}", f"RM {result['principal_income']:,.2f}")
         st.metric(f"{t['total']} {t['payment']}", result['num_payments'])
     
+    by_department = cube.by_department(month, year)
+    if not by_department.empty:
+        by_department.columns = [t['department'], t['principal'], t['interest'], t['total'], t['total_payments']]
+        st.dataframe(
+            by_department.style.format({
+                t['principal']: 'RM {:,.2f}',
+                t['interest']: 'RM {:,.2f}',
+                t['total']: 'RM {:,.2f}'
+            }),
+            use_container_width=True
+        )
+    
     st.markdown("---")
     
     col1, col2 = st.columns([1, 1])
@@ -1306,14 +1478,65 @@ with tab5:
     with col2:
         st.metric(f"{t['interest']} {t['outstanding']}", f"RM {result['outstanding_interest']:,.2f}")
     
+    # Arrears as of a chosen date, bucketed by days past due
+    st.markdown("---")
+    st.subheader(f"⏰ {t['arrears']}")
+    
+    if not borrowers.empty:
+        as_of = st.date_input(t['as_of'], value=datetime.now().date(), key="arrears_as_of")
+        schedule = get_schedule(borrowers, data_info["versions"].get("borrowers"))
+        arrears = compute_arrears(borrowers, payments, as_of, schedule)
+        
+        buckets = aging_summary(arrears)
+        cols = st.columns(len(buckets))
+        for col, (bucket, row) in zip(cols, buckets.iterrows()):
+            col.metric(f"{bucket} ({row['borrowers']})", f"RM {row['amount_overdue'] / 100:,.2f}")
+        
+        late = arrears[arrears['amount_overdue'] > 0].join(borrowers[['name', 'department']])
+        if not late.empty:
+            display = late[['name', 'department', 'amount_overdue', 'days_past_due', 'aging_bucket']].copy()
+            display['amount_overdue'] = display['amount_overdue'].astype(float) / 100
+            display = display.sort_values('days_past_due', ascending=False)
+            display.columns = [t['name'], t['department'], t['overdue'], t['days_past_due'], t['aging']]
+            
+            st.dataframe(
+                display.style.format({t['overdue']: 'RM {:,.2f}'}),
+                use_container_width=True,
+                height=300
+            )
+        else:
+            st.success(f"✅ 0 {t['overdue']}")
+    
+    # Expected inflows for the coming months
+    st.markdown("---")
+    st.subheader(f"🔮 {t['forecast']}")
+    
+    if not borrowers.empty:
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            horizon = st.slider(t['months'], 3, 24, 12, key="forecast_months")
+        with col2:
+            weighted = st.checkbox(t['on_time_weighted'], key="forecast_weighted")
+        
+        schedule = get_schedule(borrowers, data_info["versions"].get("borrowers"))
+        forecast = get_cash_flow_forecast(borrowers, payments, data_info["version"], horizon, weighted, schedule)
+        chart = pd.DataFrame({
+            t['principal']: forecast['principal_expected'] / 100,
+            t['interest']: forecast['interest_expected'] / 100
+        }, index=forecast.index)
+        fig = px.bar(chart, labels={'month': t['month'], 'value': f'{t["amount"]} (RM)', 'variable': ''})
+        fig.update_layout(height=350, margin=dict(l=20, r=20, t=40, b=20))
+        st.plotly_chart(fig, use_container_width=True)
+        st.metric(f"{t['total']} ({horizon} {t['months']})", f"RM {forecast['total_expected'].sum() / 100:,.2f}")
+    
     # Pending balance table
     st.markdown("---")
     st.subheader(f"💰 {t['pending']} {t['balance']}")
     
     if not borrowers.empty:
-        pending = borrowers[
+        pending = money_to_rm(borrowers[
             (borrowers['principal_remaining'] > 0) | (borrowers['interest_remaining'] > 0)
-        ].copy()
+        ])
         
         if not pending.empty:
             pending['total_pending'] = pending['principal_remaining'] + pending['interest_remaining']
@@ -1344,6 +1567,63 @@ with tab5:
             st.success(f"🎉 {t['fully_paid']}!")
     else:
         st.info(t['no_data'])
+    
+    # Balances still stored in the borrowers sheet from before they were
+    # derived from the payments, checked against the derived ones
+    stored = store.stored_balances()
+    if stored is not None:
+        st.markdown("---")
+        st.subheader(f"🧾 {t['reconciliation']}")
+        
+        mismatches = reconcile_balances(borrowers, stored)
+        if not mismatches.empty:
+            display = money_to_rm(mismatches, extra=[col for col in mismatches.columns if col not in ('borrower_id', 'name')])
+            display.columns = ['ID', t['name']] + [
+                f"{t[kind]} {t[state]}"
+                for kind in ('principal', 'interest') for state in ('stored', 'computed')
+            ] + [t['difference']]
+            st.dataframe(
+                display.style.format({col: 'RM {:,.2f}' for col in display.columns[2:]}),
+                use_container_width=True
+            )
+        else:
+            st.success(f"✅ {t['balances_match']}")
+        
+        if st.button(f"🗑️ {t['drop_stored']}", key="drop_stored_balances"):
+            if drop_stored_balances(store):
+                st.rerun()
+
+# ============= SIMULATION SUB-TAB =============
+with simulation_tab:
+    st.subheader(f"🎲 {t['simulation']}")
+    
+    if not borrowers.empty:
+        with st.form("simulation_form"):
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                n_sims = st.number_input(t['simulations'], min_value=100, max_value=10000, value=500, step=100)
+            with col2:
+                sim_months = st.number_input(t['months'], min_value=1, max_value=36, value=12)
+            with col3:
+                seed = st.number_input(t['seed'], min_value=0, value=0)
+            run = st.form_submit_button(f"▶️ {t['run']}", use_container_width=True)
+        
+        if run:
+            schedule = get_schedule(borrowers, data_info["versions"].get("borrowers"))
+            with st.spinner(f"{t['simulation']}..."):
+                bands = get_portfolio_simulation(
+                    borrowers, payments, data_info["version"],
+                    int(sim_months), int(n_sims), int(seed), schedule
+                )
+            
+            for measure in ("principal_outstanding", "interest_collected"):
+                chart = bands[bands['measure'] == measure].pivot(index='month', columns='percentile', values='value')
+                chart.columns = [f"P{p}" for p in chart.columns]
+                fig = px.line(chart, title=t[measure], labels={'month': t['month'], 'value': 'RM', 'variable': ''})
+                fig.update_layout(height=320, margin=dict(l=20, r=20, t=40, b=20))
+                st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.info(t['no_data'])
 
 # Footer
 st.markdown("---")
@@ -1351,3 +1631,7 @@ st.markdown(
     "<p style='text-align: center; color: #6b7280; font-size: 0.9rem;'>💚 Dibuat untuk pengurusan pinjaman yang mudah</p>",
     unsafe_allow_html=True
 )
+
+# The page above was drawn from the local snapshot; check it against the source
+if data_info["source"] == "snapshot" and data_cache.revalidate(data_info["version"]):
+    st.rerun()
@@ -111,111 +111,945 @@
 #     }
 
 import streamlit as st
-import gspread
 import pandas as pd
-from google.oauth2.service_account import Credentials
-from datetime import datetime, timedelta
+from datetime import datetime
 import numpy as np
+import threading
+import time
+import re
+from bisect import bisect_left
+from simulation import simulate, summarize
+from storage import (
+    get_storage,
+    data_version, frame_version, read_disk_snapshot, write_disk_snapshot,
+    read_balance_snapshot, write_balance_snapshot,
+    get_outbox, apply_schema, to_cents, SheetsUnavailable, WriteConflict,
+    BORROWER_SCHEMA, PAYMENT_SCHEMA, MONEY_COLUMNS, DERIVED_COLUMNS
+)
 
-# Connect to Google Sheets using Streamlit Secrets
-def get_gsheet_client():
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    creds_dict = st.secrets["gcp_service_account"]
-    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-    client = gspread.authorize(creds)
-    return client
+# Borrowers and payments shared by every session. Once frames are present a
+# read never waits on the network: when they get close to max_age a
+# background thread reloads them and swaps the new ones in.
+class DataCache:
+    REFRESH_AT = 0.8  # fraction of max_age at which a background reload starts
+    RETRY_SECONDS = 10
+    
+    def __init__(self, sheet_url, max_age=60):
+        self.sheet_url = sheet_url
+        self.max_age = max_age
+        self.last_error = None
+        self._failed_at = 0
+        self._current = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        
+        # After a restart, start from the disk snapshot and revalidate it
+        snapshot = read_disk_snapshot()
+        if snapshot is not None:
+            borrowers, payments, meta = snapshot
+            self._current = {
+                "borrowers": borrowers,
+                "payments": payments,
+                "versions": {"borrowers": frame_version(borrowers), "payments": frame_version(payments)},
+                "version": meta["version"],
+                "loaded_at": meta["saved_at"],
+                "source": "snapshot"
+            }
+    
+    # Copies of the current frames plus the version/age info they came with
+    def get(self):
+        current = self._current
+        if current is None:
+            self.refresh()
+            current = self._current
+        elif current["source"] == "snapshot" or self.age() >= self.max_age * self.REFRESH_AT:
+            self.refresh_in_background()
+        info = {k: current[k] for k in ("version", "versions", "loaded_at", "source")}
+        return current["borrowers"].copy(), current["payments"].copy(), info
+    
+    def age(self):
+        current = self._current
+        return time.time() - current["loaded_at"] if current else None
+    
+    def info(self):
+        current = self._current or {"version": None, "versions": {}, "loaded_at": None, "source": None}
+        return {k: current[k] for k in ("version", "versions", "loaded_at", "source")}
+    
+    # Load from the store now; concurrent callers share one load
+    def refresh(self):
+        started = time.time()
+        with self._load_lock:
+            current = self._current
+            if current and current["source"] == "live" and current["loaded_at"] >= started:
+                return
+            borrowers, payments = get_storage(self.sheet_url).load()
+            ledger = payments
+            payments = _with_queued_payments(payments)
+            versions = {"borrowers": frame_version(borrowers), "payments": frame_version(payments)}
+            version = data_version(borrowers, payments, versions)
+            # Roll the balance snapshots forward (stored rows only, not the
+            # queued ones) and keep a copy on disk for the first render after a restart
+            try:
+                get_ledger_snapshots().update(ledger)
+                write_disk_snapshot(borrowers, payments, version)
+            except Exception as e:
+                self.last_error = f"Could not write local snapshot: {str(e)}"
+            else:
+                self.last_error = None
+            self._current = {
+                "borrowers": borrowers,
+                "payments": payments,
+                "versions": versions,
+                "version": version,
+                "loaded_at": time.time(),
+                "source": "live"
+            }
+    
+    def refresh_in_background(self):
+        if time.time() - self._failed_at < self.RETRY_SECONDS:
+            return
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._background_refresh, daemon=True)
+            self._thread.start()
+    
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # Keep serving the previous frames
+            self.last_error = str(e)
+            self._failed_at = time.time()
+    
+    # Replace one dataset with the frame just written and bump only its version.
+    # Waits for an in-flight reload so it cannot overwrite the patch.
+    def patch(self, name, df):
+        with self._load_lock:
+            current = self._current
+            if current is None:
+                return
+            updated = dict(current)
+            updated[name] = df.copy()
+            updated["versions"] = {**current["versions"], name: frame_version(df)}
+            updated["version"] = data_version(None, None, updated["versions"])
+            self._current = updated
+    
+    # Wait for a background reload; True if the data changed from `version`
+    def revalidate(self, version, timeout=30):
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        current = self._current
+        return current is not None and current["version"] != version
+
+_data_caches = {}
+_data_caches_lock = threading.Lock()
+
+def get_data_cache(sheet_url):
+    with _data_caches_lock:
+        if sheet_url not in _data_caches:
+            _data_caches[sheet_url] = DataCache(sheet_url)
+        return _data_caches[sheet_url]
+
+# Patch the shared frames of every cache backed by this store
+def _patch_data_caches(store, name, df):
+    for cache in list(_data_caches.values()):
+        if get_storage(cache.sheet_url) is store:
+            cache.patch(name, df)
+
+# Load borrowers and payments with error handling, plus the version info of
+# exactly these frames (used to key caches of derived structures)
+def load_versioned_data(sheet_url):
+    try:
+        return get_data_cache(sheet_url).get()
+    except Exception as e:
+        st.error(f"Error loading data: {str(e)}")
+        return pd.DataFrame(), pd.DataFrame(), {"version": None, "versions": {}, "loaded_at": None, "source": None}
 
-# Load all sheets with error handling
-@st.cache_data(ttl=60)
 def load_data(sheet_url):
+    borrowers, payments, _ = load_versioned_data(sheet_url)
+    return borrowers, payments
+
+# Reload now, e.g. from the Refresh button
+def refresh_data(sheet_url):
     try:
-        client = get_gsheet_client()
-        sh = client.open_by_url(sheet_url)
-        borrowers_ws = sh.worksheet("borrowers")
-        payments_ws = sh.worksheet("payments")
-        
-        borrowers = pd.DataFrame(borrowers_ws.get_all_records())
-        payments = pd.DataFrame(payments_ws.get_all_records())
-        
-        # Convert data types
-        if not borrowers.empty:
-            borrowers['principal_total'] = pd.to_numeric(borrowers['principal_total'], errors='coerce')
-            borrowers['interest_total'] = pd.to_numeric(borrowers['interest_total'], errors='coerce')
-            borrowers['principal_remaining'] = pd.to_numeric(borrowers['principal_remaining'], errors='coerce')
-            borrowers['interest_remaining'] = pd.to_numeric(borrowers['interest_remaining'], errors='coerce')
-            borrowers['months_to_pay'] = pd.to_numeric(borrowers['months_to_pay'], errors='coerce')
-        
-        if not payments.empty:
-            payments['principal_paid'] = pd.to_numeric(payments['principal_paid'], errors='coerce')
-            payments['interest_paid'] = pd.to_numeric(payments['interest_paid'], errors='coerce')
-            payments['date'] = pd.to_datetime(payments['date'], errors='coerce')
-        
-        return borrowers, payments, borrowers_ws, payments_ws
+        get_data_cache(sheet_url).refresh()
+        return True
+    except SheetsUnavailable as e:
+        st.warning(str(e))
+        return False
     except Exception as e:
         st.error(f"Error loading data: {str(e)}")
-        return pd.DataFrame(), pd.DataFrame(), None, None
+        return False
 
-# Save borrowers back to Google Sheet
-def save_borrowers(df, worksheet):
+# Save borrowers back to the store, writing only changed and new borrowers
+def save_borrowers(df, store):
     try:
-        worksheet.clear()
-        worksheet.update([df.columns.values.tolist()] + df.values.tolist())
-        st.cache_data.clear()
+        store.save_borrowers(df)
+        _patch_data_caches(store, "borrowers", df)
         return True
     except Exception as e:
         st.error(f"Error saving borrowers: {str(e)}")
         return False
 
-# Save payments back to Google Sheet
-def save_payments(df, worksheet):
+# Save payments back to the store, appending only rows added since the last load
+def save_payments(df, store):
+    try:
+        store.save_payments(df)
+        _patch_data_caches(store, "payments", df)
+        return True
+    except Exception as e:
+        st.error(f"Error saving payments: {str(e)}")
+        return False
+
+# One string per payment row, for matching queued payments to stored ones
+def _payment_keys(df):
+    return (
+        df["payment_id"].astype("string") + "|" + df["borrower_id"].astype("string") + "|"
+        + df["date"].dt.strftime("%Y-%m-%d %H:%M:%S") + "|"
+        + df["principal_paid"].astype("string") + "|" + df["interest_paid"].astype("string")
+    ).fillna("")
+
+# Payments still waiting in the outbox, appended to a loaded ledger so that
+# a reload does not hide them before they have been written
+def _with_queued_payments(payments):
+    queued = get_outbox().pending()
+    if queued.empty:
+        return payments
+    if not payments.empty:
+        queued = queued[~_payment_keys(queued).isin(_payment_keys(payments))]
+        queued = queued.reindex(columns=payments.columns)
+    else:
+        queued = queued.drop(columns=["seq", "queued_at"])
+    return pd.concat([payments, queued], ignore_index=True)
+
+# Writes queued payments to the store in the background. Payments are taken
+# from the outbox in queue order, coalesced into one append per flush, and
+# removed from the outbox only after the write succeeded; rows the store
+# already has (a flush interrupted after writing) are skipped. Balances are
+# derived on read, so the borrowers are never rewritten. One writer per
+# store, so flushes never overlap.
+class PaymentWriter:
+    FLUSH_DELAY = 2  # seconds to wait for more payments before writing
+    RETRY_SECONDS = 10
+    MAX_CONFLICTS = 3
+    
+    def __init__(self, store):
+        self.store = store
+        self.outbox = get_outbox()
+        self.lock = threading.Lock()
+        self.flushed = 0
+        self.last_flush_at = None
+        self.last_error = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        if self.outbox.count():
+            self.start()
+    
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+    
+    # Queue one payment row (typed, cents) and wake the flusher
+    def enqueue(self, row):
+        self.outbox.put(row)
+        self.start()
+    
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.FLUSH_DELAY)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.last_error = str(e)
+                time.sleep(self.RETRY_SECONDS)
+                self._wake.set()
+            if self.outbox.count():
+                self._wake.set()
+    
+    def flush(self):
+        queued = self.outbox.pending()
+        if queued.empty:
+            return 0
+        for attempt in range(self.MAX_CONFLICTS + 1):
+            try:
+                self._write(queued)
+                break
+            except WriteConflict:
+                # Someone else wrote first: reload and allocate ids again
+                if attempt == self.MAX_CONFLICTS:
+                    raise
+                self.store.load()
+                queued = self.outbox.pending()
+        self.outbox.done(queued["seq"])
+        _patch_data_caches(self.store, "payments", _with_queued_payments(self.store.loaded("payments")))
+        self.flushed += len(queued)
+        self.last_flush_at = time.time()
+        self.last_error = None
+        return len(queued)
+    
+    # Compare-and-append: ids follow the ledger the store is about to check
+    # against, and are recorded in the outbox before the rows are written
+    def _write(self, queued):
+        with self.store.lock:
+            payments = self.store.loaded("payments")
+            if payments is None:
+                _, payments = self.store.load()
+            new = queued[~_payment_keys(queued).isin(_payment_keys(payments))] if not payments.empty else queued
+            if new.empty:
+                return
+            last = payments["payment_id"].max() if not payments.empty else None
+            start = int(last) + 1 if pd.notna(last) else 1
+            ids = list(range(start, start + len(new)))
+            self.outbox.assign_ids(new["seq"], ids)
+            new = new.assign(payment_id=pd.array(ids, dtype="Int32"))
+            payments = pd.concat(
+                [payments, new.reindex(columns=payments.columns if not payments.empty else PAYMENT_SCHEMA.keys())],
+                ignore_index=True
+            )
+            self.store.save_payments(payments)
+    
+    # Progress for the UI: queued count, totals and the last error
+    def status(self):
+        return {
+            "pending": self.outbox.count(),
+            "flushed": self.flushed,
+            "last_flush_at": self.last_flush_at,
+            "last_error": self.last_error
+        }
+
+_payment_writers = {}
+_payment_writers_lock = threading.Lock()
+
+def get_payment_writer(store):
+    with _payment_writers_lock:
+        if id(store) not in _payment_writers:
+            _payment_writers[id(store)] = PaymentWriter(store)
+        return _payment_writers[id(store)]
+
+# Record a payment without waiting on the store: it is committed to the local
+# outbox, shown in the shared frames at once and written by the PaymentWriter
+def record_payment(sheet_url, store, borrower_id, principal, interest):
     try:
-        worksheet.clear()
-        worksheet.update([df.columns.values.tolist()] + df.values.tolist())
-        st.cache_data.clear()
+        writer = get_payment_writer(store)
+        with writer.lock:
+            _, payments, _ = get_data_cache(sheet_url).get()
+            payments = add_payment(borrower_id, principal, interest, payments)
+            writer.enqueue(payments.iloc[-1])
+        _patch_data_caches(store, "payments", payments)
         return True
     except Exception as e:
         st.error(f"Error saving payments: {str(e)}")
         return False
 
-# Compute balances and payment status
-def compute_balances(borrowers, payments):
+# Reverse a recorded payment: the ledger is append-only, so a reversal entry
+# is queued like any other payment. Payments still in the outbox can be
+# renumbered when written, so they have to be written before being reversed.
+def reverse_payment(sheet_url, store, payment_id):
+    try:
+        writer = get_payment_writer(store)
+        with writer.lock:
+            if (writer.outbox.pending()["payment_id"] == payment_id).any():
+                raise ValueError(f"payment {payment_id} is still being saved, please try again shortly")
+            _, payments, _ = get_data_cache(sheet_url).get()
+            payments = add_reversal(payment_id, payments)
+            writer.enqueue(payments.iloc[-1])
+        _patch_data_caches(store, "payments", payments)
+        return True
+    except Exception as e:
+        st.error(f"Error saving payments: {str(e)}")
+        return False
+
+# Add a borrower and save it. The id is allocated from the store's own view
+# of the sheet, which the save checks against the source; if someone else
+# changed the borrowers in between, reload and allocate again.
+def register_borrower(sheet_url, store, name, dept, phone, principal, interest_rate, start_date, months):
+    try:
+        for attempt in range(PaymentWriter.MAX_CONFLICTS + 1):
+            with store.lock:
+                borrowers = store.loaded("borrowers")
+                if borrowers is None:
+                    borrowers, _ = store.load()
+                borrowers = add_borrower(borrowers, name, dept, phone, principal, interest_rate, start_date, months)
+                try:
+                    store.save_borrowers(borrowers)
+                    break
+                except WriteConflict:
+                    if attempt == PaymentWriter.MAX_CONFLICTS:
+                        raise
+                    store.load()
+        _patch_data_caches(store, "borrowers", borrowers)
+        return True
+    except Exception as e:
+        st.error(f"Error saving borrowers: {str(e)}")
+        return False
+
+# Copy of a frame with money columns converted from cents to RM, for display
+def money_to_rm(df, extra=("total_paid", "principal_paid_to_date", "interest_paid_to_date")):
+    df = df.copy()
+    for col in df.columns:
+        if col in MONEY_COLUMNS or col in extra:
+            df[col] = df[col].astype("Float64").div(100).astype(float)
+    return df
+
+# Payment totals (cents) and number of payments per (month, borrower_id) of
+# a stretch of the ledger; undated payments fall under a blank month.
+# Reversal entries net off the amounts but are not counted as payments.
+def _ledger_totals(payments):
+    if payments.empty:
+        payments = apply_schema(pd.DataFrame(columns=PAYMENT_SCHEMA.keys()), PAYMENT_SCHEMA)
+    totals = payments[["principal_paid", "interest_paid"]].fillna(0)
+    reversal = payments["reverses"].notna() if "reverses" in payments.columns else pd.Series(False, index=payments.index)
+    totals["payments"] = (~reversal).astype(np.int64)
+    month = payments["date"].dt.to_period("M").dt.to_timestamp().astype("datetime64[ns]").rename("month")
+    return totals.groupby([month, payments["borrower_id"]], dropna=False).sum()
+
+def _combine_totals(*frames):
+    return pd.concat(frames).groupby(level=["month", "borrower_id"], dropna=False).sum()
+
+# Fingerprint of ledger rows, covering every field the totals depend on
+def _ledger_fingerprint(payments):
+    reversal = payments["reverses"].notna() if "reverses" in payments.columns else pd.Series(False, index=payments.index)
+    return frame_version(pd.DataFrame({
+        "payment_id": payments["payment_id"].astype("Int64"),
+        "borrower_id": payments["borrower_id"].astype("Int64"),
+        "date": payments["date"].astype("datetime64[ns]"),
+        "principal_paid": payments["principal_paid"].astype("Int64"),
+        "interest_paid": payments["interest_paid"].astype("Int64"),
+        "reversal": reversal.to_numpy(dtype=bool)
+    }))
+
+# Ledger state as "last snapshot + events since". The snapshot holds the
+# _ledger_totals() of the first `through` rows of the append-only ledger and
+# a fingerprint of those rows. It is persisted next to the local frame
+# snapshot and rolled forward once a month, so reads only aggregate the
+# payments appended since. The fingerprint is checked by update(), once per
+# loaded ledger (DataCache.refresh); a ledger whose first `through` rows no
+# longer match (another sheet, a row edited by hand) rebuilds the snapshot
+# there. Reads only check the length, and read the ledger in full until a
+# snapshot has been checked in this process.
+class LedgerSnapshots:
+    def __init__(self):
+        self.lock = threading.Lock()
+        saved = read_balance_snapshot()
+        if saved is None:
+            self._set(_ledger_totals(pd.DataFrame()), 0, None, None, True)
+        else:
+            balances, meta = saved
+            self._set(balances.set_index(["month", "borrower_id"]), meta["through"], meta.get("fingerprint"), meta["taken"], False)
+    
+    # Replace the snapshot in one assignment, so readers never mix two
+    def _set(self, balances, through, fingerprint, taken, checked):
+        borrower_totals = balances.groupby(level="borrower_id").sum()
+        self._state = (balances, borrower_totals, through, fingerprint, taken, checked)
+    
+    # The state, or None when it cannot be used for this ledger
+    def _state_for(self, payments):
+        state = self._state
+        if not state[5] or len(payments) < state[2]:
+            return None
+        return state
+    
+    # Check the snapshot against a freshly loaded ledger, then fold the
+    # ledger into it once a month (or rebuild it when the snapshotted rows no
+    # longer match) and persist it. Returns True when a new snapshot was taken.
+    def update(self, payments):
+        month = datetime.now().strftime("%Y-%m")
+        with self.lock:
+            state = self._state
+            through, fingerprint = state[2], state[3]
+            if through and (len(payments) < through or _ledger_fingerprint(payments.iloc[:through]) != fingerprint):
+                balances = _ledger_totals(payments)
+            elif state[4] == month or len(payments) == through:
+                if not state[5]:
+                    self._state = state[:5] + (True,)
+                return False
+            else:
+                balances = _combine_totals(state[0], _ledger_totals(payments.iloc[through:]))
+            fingerprint = _ledger_fingerprint(payments) if not payments.empty else None
+            self._set(balances, len(payments), fingerprint, month, True)
+            write_balance_snapshot(balances.reset_index(), {"through": len(payments), "fingerprint": fingerprint, "taken": month})
+            return True
+    
+    # Totals per (month, borrower_id) of the whole ledger
+    def monthly(self, payments):
+        state = self._state_for(payments)
+        if state is None:
+            return _ledger_totals(payments)
+        return _combine_totals(state[0], _ledger_totals(payments.iloc[state[2]:]))
+    
+    # Totals per borrower_id of the whole ledger
+    def totals(self, payments):
+        state = self._state_for(payments)
+        if state is None:
+            return _ledger_totals(payments).groupby(level="borrower_id").sum()
+        recent = _ledger_totals(payments.iloc[state[2]:]).groupby(level="borrower_id").sum()
+        return pd.concat([state[1], recent]).groupby(level="borrower_id").sum()
+
+# One set of snapshots per process, kept with the local frame snapshot
+@st.cache_resource
+def get_ledger_snapshots():
+    return LedgerSnapshots()
+
+@st.cache_resource(max_entries=4)
+def _cached_payment_totals(_payments, version):
+    return get_ledger_snapshots().totals(_payments)
+
+# Per-borrower payment totals, built once per payments version
+def get_payment_totals(payments, version):
+    if version is None:
+        return get_ledger_snapshots().totals(payments)
+    return _cached_payment_totals(payments, version)
+
+# Compute balances and payment status. Balances are not stored; they are
+# derived from the per-borrower payment totals of the ledger snapshots (pass
+# `paid` to reuse cached ones)
+def compute_balances(borrowers, payments, paid=None):
     if borrowers.empty:
         return borrowers
     
-    for idx, row in borrowers.iterrows():
-        pid = row["borrower_id"]
-        df = payments[payments["borrower_id"] == pid]
-        principal_paid = df["principal_paid"].sum() if not df.empty else 0
-        interest_paid = df["interest_paid"].sum() if not df.empty else 0
-        borrowers.at[idx, "principal_remaining"] = row["principal_total"] - principal_paid
-        borrowers.at[idx, "interest_remaining"] = row["interest_total"] - interest_paid
+    if paid is None:
+        paid = get_ledger_snapshots().totals(payments)
+    principal_paid = borrowers["borrower_id"].map(paid["principal_paid"]).fillna(0)
+    interest_paid = borrowers["borrower_id"].map(paid["interest_paid"]).fillna(0)
+    borrowers["principal_remaining"] = borrowers["principal_total"] - principal_paid
+    borrowers["interest_remaining"] = borrowers["interest_total"] - interest_paid
     return borrowers
 
-# Calculate payment schedule
+SCHEDULE_COLUMNS = [
+    "borrower_id", "installment", "due_date",
+    "principal_due", "interest_due", "total_due",
+    "principal_due_to_date", "interest_due_to_date"
+]
+
+# Due dates `installment` calendar months after each start date. The day of
+# month is kept, clipped to shorter months, and loans started on a month end
+# stay on month ends (31 Jan -> 28 Feb -> 31 Mar)
+def _add_months(start, installment):
+    start = start.astype("datetime64[D]")
+    start_month = start.astype("datetime64[M]")
+    day = (start - start_month.astype("datetime64[D]")).astype(np.int64)
+    start_length = ((start_month + 1).astype("datetime64[D]") - start_month.astype("datetime64[D]")).astype(np.int64)
+    
+    due_month = start_month + installment
+    due_first = due_month.astype("datetime64[D]")
+    length = ((due_month + 1).astype("datetime64[D]") - due_first).astype(np.int64)
+    day = np.where(day == start_length - 1, length - 1, np.minimum(day, length - 1))
+    return due_first + day
+
+# Amortization schedule for every loan in one long table (cents), one row per
+# installment. Principal and interest are split evenly with the rounding
+# remainder on the last installment, so each loan sums to its totals exactly
+def build_schedule(borrowers):
+    if borrowers.empty:
+        return pd.DataFrame(columns=SCHEDULE_COLUMNS).astype({"due_date": "datetime64[ns]"})
+    
+    valid = borrowers[
+        borrowers["borrower_id"].notna()
+        & borrowers["loan_start_date"].notna()
+        & (borrowers["months_to_pay"].fillna(0) > 0)
+    ]
+    months = valid["months_to_pay"].to_numpy(dtype=np.int64)
+    rows = np.repeat(np.arange(len(valid)), months)
+    offsets = np.repeat(np.cumsum(months) - months, months)
+    installment = np.arange(len(rows)) - offsets + 1
+    is_last = installment == months[rows]
+    
+    schedule = pd.DataFrame({
+        "borrower_id": valid["borrower_id"].array.take(rows),
+        "installment": installment.astype(np.int16),
+        "due_date": _add_months(
+            valid["loan_start_date"].to_numpy(dtype="datetime64[ns]")[rows], installment
+        ).astype("datetime64[ns]")
+    })
+    for col, total in (("principal_due", "principal_total"), ("interest_due", "interest_total")):
+        amount = valid[total].fillna(0).to_numpy(dtype=np.int64)
+        base = amount // months
+        last = amount - base * (months - 1)
+        schedule[col] = pd.array(np.where(is_last, last[rows], base[rows]), dtype="Int64")
+    schedule["total_due"] = schedule["principal_due"] + schedule["interest_due"]
+    by_borrower = schedule.groupby("borrower_id", sort=False)
+    schedule["principal_due_to_date"] = by_borrower["principal_due"].cumsum()
+    schedule["interest_due_to_date"] = by_borrower["interest_due"].cumsum()
+    
+    order = np.lexsort((installment, schedule["borrower_id"].to_numpy(dtype=np.int64)))
+    return schedule.iloc[order].reset_index(drop=True)
+
+@st.cache_resource(max_entries=4)
+def _cached_schedule(_borrowers, version):
+    return build_schedule(_borrowers)
+
+# Portfolio schedule built once per borrowers version (it only depends on
+# the loan terms, not on payments)
+def get_schedule(borrowers, version):
+    if version is None:
+        return build_schedule(borrowers)
+    return _cached_schedule(borrowers, version)
+
+# One borrower's rows of a schedule (sorted by borrower_id)
+def schedule_for(schedule, borrower_id):
+    ids = schedule["borrower_id"].to_numpy(dtype=np.int64)
+    lo, hi = np.searchsorted(ids, [borrower_id, borrower_id + 1])
+    return schedule.iloc[lo:hi]
+
+AGING_BUCKETS = ["Current", "1-30", "31-60", "61-90", "90+"]
+
+# Arrears of every borrower as of a date: what the schedule says should have
+# been paid before then against what was paid up to then (cents).
+# days_past_due counts from the oldest installment not covered by payments
+def compute_arrears(borrowers, payments, as_of=None, schedule=None):
+    as_of = pd.Timestamp(as_of if as_of is not None else datetime.now()).normalize()
+    if borrowers.empty:
+        return pd.DataFrame(columns=["borrower_id", "amount_due", "amount_paid",
+                                     "amount_overdue", "days_past_due", "aging_bucket"])
+    if schedule is None:
+        schedule = build_schedule(borrowers)
+    
+    ids = borrowers["borrower_id"]
+    if payments.empty:
+        paid = pd.Series(dtype="Int64")
+    else:
+        upto = payments[payments["date"] < as_of + pd.Timedelta(days=1)]
+        paid = (upto["principal_paid"] + upto["interest_paid"]).groupby(upto["borrower_id"]).sum()
+    
+    due_rows = schedule[schedule["due_date"] < as_of]
+    cumulative = due_rows["principal_due_to_date"] + due_rows["interest_due_to_date"]
+    due = cumulative.groupby(due_rows["borrower_id"], sort=False).last()
+    
+    # Oldest installment whose running total is still ahead of the payments
+    unpaid = cumulative > due_rows["borrower_id"].map(paid).fillna(0)
+    oldest = due_rows.loc[unpaid, "due_date"].groupby(due_rows.loc[unpaid, "borrower_id"], sort=False).first()
+    
+    amount_due = ids.map(due).fillna(0).astype("Int64")
+    amount_paid = ids.map(paid).fillna(0).astype("Int64")
+    oldest = pd.Series(oldest.reindex(ids.to_numpy()).to_numpy(dtype="datetime64[ns]"), index=ids.index)
+    days = (as_of - oldest).dt.days.fillna(0).astype("Int64")
+    
+    arrears = pd.DataFrame({
+        "borrower_id": ids,
+        "amount_due": amount_due,
+        "amount_paid": amount_paid,
+        "amount_overdue": (amount_due - amount_paid).clip(lower=0),
+        "days_past_due": days
+    }, index=borrowers.index)
+    arrears["aging_bucket"] = pd.cut(
+        arrears["days_past_due"].astype(int), [-1, 0, 30, 60, 90, np.inf], labels=AGING_BUCKETS
+    )
+    return arrears
+
+# Borrower count and overdue cents per aging bucket
+def aging_summary(arrears):
+    return arrears.groupby("aging_bucket", observed=False).agg(
+        borrowers=("borrower_id", "size"),
+        amount_overdue=("amount_overdue", "sum")
+    )
+
+# Share of each borrower's past installments that were covered by payments
+# made on or before the due date (1.0 for loans with nothing due yet)
+def on_time_rates(payments, schedule, as_of=None):
+    as_of = pd.Timestamp(as_of if as_of is not None else datetime.now()).normalize()
+    past = schedule[schedule["due_date"] < as_of]
+    if past.empty:
+        return pd.Series(dtype=float)
+    
+    due = past[["borrower_id", "due_date"]].copy()
+    due["due_end"] = (due["due_date"] + pd.Timedelta(days=1)).astype("datetime64[ns]")
+    due["due_to_date"] = past["principal_due_to_date"] + past["interest_due_to_date"]
+    
+    paid = payments[payments["date"].notna() & payments["borrower_id"].notna()]
+    paid = paid.assign(
+        date=paid["date"].astype("datetime64[ns]"),
+        total=paid["principal_paid"].fillna(0) + paid["interest_paid"].fillna(0)
+    ).sort_values("date")
+    paid["paid_to_date"] = paid.groupby("borrower_id")["total"].cumsum()
+    
+    merged = pd.merge_asof(
+        due.sort_values("due_end"), paid[["borrower_id", "date", "paid_to_date"]],
+        left_on="due_end", right_on="date", by="borrower_id", allow_exact_matches=False
+    )
+    on_time = merged["paid_to_date"].fillna(0) >= merged["due_to_date"]
+    return on_time.groupby(merged["borrower_id"]).mean()
+
+# What is still owed on each installment (cents) and the month it is expected
+# in, counted from the as-of month. Payments made so far are applied to each
+# loan's oldest installments first; what is still unpaid from past months is
+# expected in month 0
+def _remaining_installments(schedule, payments, as_of):
+    if payments.empty:
+        paid = pd.DataFrame(columns=["principal_paid", "interest_paid"], dtype="Int64")
+    else:
+        paid = payments.groupby("borrower_id")[["principal_paid", "interest_paid"]].sum()
+    
+    remaining = pd.DataFrame({"borrower_id": schedule["borrower_id"]})
+    for kind in ("principal", "interest"):
+        already = schedule["borrower_id"].map(paid[f"{kind}_paid"]).fillna(0)
+        left = (schedule[f"{kind}_due_to_date"] - already).clip(lower=0)
+        remaining[f"{kind}_expected"] = np.minimum(left, schedule[f"{kind}_due"]).to_numpy(dtype=float)
+    
+    first = as_of.year * 12 + as_of.month - 1
+    due = schedule["due_date"]
+    remaining["month"] = np.maximum((due.dt.year * 12 + due.dt.month - 1 - first).to_numpy(dtype=np.int64), 0)
+    return remaining[(remaining["principal_expected"] > 0) | (remaining["interest_expected"] > 0)]
+
+# Expected inflows (cents) per month for the next `months` months. With
+# use_on_time_rates each borrower's amounts are weighted by on_time_rates()
+def forecast_cash_flow(borrowers, payments, months=12, as_of=None, schedule=None, use_on_time_rates=False):
+    as_of = pd.Timestamp(as_of if as_of is not None else datetime.now()).normalize()
+    index = pd.period_range(as_of.to_period("M"), periods=months, freq="M").to_timestamp()
+    if schedule is None:
+        schedule = build_schedule(borrowers)
+    
+    remaining = _remaining_installments(schedule, payments, as_of)
+    remaining = remaining[remaining["month"] < months]
+    expected = remaining[["principal_expected", "interest_expected"]]
+    if use_on_time_rates and not remaining.empty:
+        rates = remaining["borrower_id"].map(on_time_rates(payments, schedule, as_of)).fillna(1.0)
+        expected = expected.mul(rates.to_numpy(dtype=float), axis=0)
+    
+    forecast = expected.groupby(remaining["month"]).sum().reindex(range(months), fill_value=0.0).round()
+    forecast.index = pd.Index(index, name="month")
+    forecast["total_expected"] = forecast["principal_expected"] + forecast["interest_expected"]
+    return forecast
+
+@st.cache_resource(max_entries=8)
+def _cached_forecast(_borrowers, _payments, _schedule, version, months, use_on_time_rates, day):
+    return forecast_cash_flow(_borrowers, _payments, months, day, _schedule, use_on_time_rates)
+
+# Forecast cached per data version, horizon, weighting and calendar day
+def get_cash_flow_forecast(borrowers, payments, version, months=12, use_on_time_rates=False, schedule=None):
+    day = datetime.now().strftime("%Y-%m-%d")
+    if version is None:
+        return forecast_cash_flow(borrowers, payments, months, day, schedule, use_on_time_rates)
+    return _cached_forecast(borrowers, payments, schedule, version, months, use_on_time_rates, day)
+
+# Monte Carlo what-if over the next `months` months, with per-borrower
+# behaviour taken from the ledger: on-time probability from on_time_rates(),
+# mean slip from the borrower's current days past due (else the portfolio
+# average), and a monthly default hazard from the share of loans 90+ days
+# late, scaled by how often the borrower pays late. Returns percentile bands
+# (RM) of cumulative interest collected and outstanding principal per month
+def run_portfolio_simulation(borrowers, payments, months=12, n_sims=1000, seed=0,
+                             as_of=None, schedule=None, workers=None):
+    as_of = pd.Timestamp(as_of if as_of is not None else datetime.now()).normalize()
+    index = pd.period_range(as_of.to_period("M"), periods=months, freq="M").to_timestamp()
+    if schedule is None:
+        schedule = build_schedule(borrowers)
+    
+    remaining = _remaining_installments(schedule, payments, as_of)
+    remaining = remaining[remaining["month"] < months]
+    codes, ids = pd.factorize(remaining["borrower_id"])
+    
+    on_time = on_time_rates(payments, schedule, as_of).reindex(ids).fillna(1.0).to_numpy(dtype=float)
+    arrears = compute_arrears(borrowers, payments, as_of, schedule).set_index("borrower_id")
+    late_days = arrears["days_past_due"][arrears["days_past_due"] > 0]
+    typical_delay = late_days.mean() / 30 if not late_days.empty else 1.0
+    mean_delay = (arrears["days_past_due"].reindex(ids).fillna(0).to_numpy(dtype=float) / 30)
+    mean_delay = np.where(mean_delay > 0, mean_delay, typical_delay)
+    
+    owing = arrears[arrears["amount_due"] > 0]
+    defaulted = (owing["days_past_due"] > 90).mean() if not owing.empty else 0.0
+    base_hazard = 1 - (1 - defaulted) ** (1 / 12)
+    lateness = 1 - on_time
+    default_hazard = base_hazard * lateness / lateness.mean() if lateness.mean() > 0 else np.full(len(ids), base_hazard)
+    
+    outstanding = float(borrowers["principal_remaining"].sum()) if not borrowers.empty else 0.0
+    result = simulate(
+        codes, remaining["month"], remaining["principal_expected"], remaining["interest_expected"],
+        on_time, mean_delay, default_hazard, months, outstanding, n_sims, seed, workers
+    )
+    return summarize(result, index)
+
+@st.cache_resource(max_entries=4)
+def _cached_simulation(_borrowers, _payments, _schedule, version, months, n_sims, seed, day):
+    return run_portfolio_simulation(_borrowers, _payments, months, n_sims, seed, day, _schedule)
+
+# Simulation cached per data version, parameters and calendar day (the
+# result is fully determined by them because the run is seeded)
+def get_portfolio_simulation(borrowers, payments, version, months=12, n_sims=1000, seed=0, schedule=None):
+    day = datetime.now().strftime("%Y-%m-%d")
+    if version is None:
+        return run_portfolio_simulation(borrowers, payments, months, n_sims, seed, day, schedule)
+    return _cached_simulation(borrowers, payments, schedule, version, months, n_sims, seed, day)
+
+# Calculate payment schedule for a single loan (RM), on calendar months
 def calculate_payment_schedule(principal, interest_rate, months, start_date):
-    monthly_principal = principal / months
-    monthly_interest = (principal * interest_rate) / months
-    
-    schedule = []
-    current_date = pd.to_datetime(start_date)
-    
-    for month in range(1, months + 1):
-        payment_date = current_date + timedelta(days=30 * month)
-        schedule.append({
-            'month': month,
-            'due_date': payment_date.strftime('%Y-%m-%d'),
-            'principal_due': monthly_principal,
-            'interest_due': monthly_interest,
-            'total_due': monthly_principal + monthly_interest
-        })
-    
-    return pd.DataFrame(schedule)
-
-# Get payment history for borrower
-def get_payment_history(borrower_id, payments):
+    loan = pd.DataFrame({
+        "borrower_id": pd.array([0], dtype="Int32"),
+        "loan_start_date": [pd.to_datetime(start_date)],
+        "months_to_pay": pd.array([months], dtype="Int16"),
+        "principal_total": pd.array([to_cents(principal)], dtype="Int64"),
+        "interest_total": pd.array([to_cents(principal * interest_rate)], dtype="Int64")
+    })
+    schedule = build_schedule(loan)
+    return pd.DataFrame({
+        'month': schedule["installment"].astype(int),
+        'due_date': schedule["due_date"].dt.strftime('%Y-%m-%d'),
+        'principal_due': schedule["principal_due"].astype(float) / 100,
+        'interest_due': schedule["interest_due"].astype(float) / 100,
+        'total_due': schedule["total_due"].astype(float) / 100
+    })
+
+# Payments sorted by (borrower_id, date) with per-borrower running totals and
+# the offset where each borrower's block starts, so one history is a slice
+# found by binary search. The loaded frame itself stays in sheet order
+# because saves diff it against the sheet by position.
+class PaymentIndex:
+    def __init__(self, payments):
+        if payments.empty or "borrower_id" not in payments.columns:
+            self.sorted = pd.DataFrame()
+            self.ids = self.starts = self.ends = np.array([], dtype=np.int64)
+            return
+        
+        valid = payments[payments["borrower_id"].notna()]
+        borrower_ids = valid["borrower_id"].to_numpy(dtype=np.int64)
+        dates = valid["date"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        order = np.lexsort((dates, borrower_ids))
+        
+        self.sorted = valid.iloc[order].reset_index(drop=True)
+        self.sorted["total_paid"] = self.sorted["principal_paid"] + self.sorted["interest_paid"]
+        by_borrower = self.sorted.groupby("borrower_id", sort=False)
+        self.sorted["principal_paid_to_date"] = by_borrower["principal_paid"].cumsum()
+        self.sorted["interest_paid_to_date"] = by_borrower["interest_paid"].cumsum()
+        
+        self.ids, self.starts = np.unique(borrower_ids[order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(self.sorted))
+
+    # One borrower's payments, oldest first
+    def slice(self, borrower_id):
+        pos = np.searchsorted(self.ids, borrower_id)
+        if pos >= len(self.ids) or self.ids[pos] != borrower_id:
+            return self.sorted.iloc[0:0]
+        return self.sorted.iloc[self.starts[pos]:self.ends[pos]]
+
+@st.cache_resource(max_entries=4)
+def _cached_payment_index(_payments, version):
+    return PaymentIndex(_payments)
+
+# Index over the payments frame, built once per payments version
+def get_payment_index(payments, version):
+    if version is None:
+        return PaymentIndex(payments)
+    return _cached_payment_index(payments, version)
+
+SEARCH_LIMIT = 20
+SEARCH_MIN_SIMILARITY = 0.3
+
+# Lower-case alphanumeric words of a search string
+def _search_tokens(text):
+    return re.findall(r"[0-9a-z]+", text.lower())
+
+# Distinct trigrams of a set of words, padded so short words still match
+def _trigrams(words):
+    grams = set()
+    for word in words:
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+# Selectbox labels ("name · phone · #id") for every borrower, and for those
+# with principal left, plus hash maps from label and id to row position, so
+# selecting a borrower is O(1) and two people with the same name stay distinct
+class BorrowerLookup:
+    def __init__(self, borrowers):
+        if borrowers.empty:
+            self.labels, self.active_labels = [], []
+            self.positions, self.by_id = {}, {}
+            return
+        
+        names = borrowers["name"].astype("string").fillna("-")
+        phones = borrowers["phone"].astype("string").fillna("-")
+        ids = borrowers["borrower_id"].astype("string").fillna("?")
+        self.labels = (names + " · " + phones + " · #" + ids).tolist()
+        self.positions = {label: i for i, label in enumerate(self.labels)}
+        self.by_id = {
+            int(bid): i for i, bid in enumerate(borrowers["borrower_id"]) if pd.notna(bid)
+        }
+        active = (borrowers["principal_remaining"] > 0).fillna(False).to_numpy(dtype=bool)
+        self.active = active
+        self.active_labels = [self.labels[i] for i in np.flatnonzero(active)]
+        self._build_search(borrowers)
+
+    # Search index over name, phone and department: a sorted token list for
+    # prefix matches and a trigram -> row positions map for typo-tolerant ones
+    def _build_search(self, borrowers):
+        text = (
+            borrowers["name"].astype("string").fillna("") + " "
+            + borrowers["phone"].astype("string").fillna("").str.replace(r"\D", "", regex=True) + " "
+            + borrowers["department"].astype("string").fillna("")
+        ).tolist()
+        
+        tokens, grams = [], {}
+        for pos, row in enumerate(text):
+            row_tokens = set(_search_tokens(row))
+            tokens.extend((token, pos) for token in row_tokens)
+            for gram in _trigrams(row_tokens):
+                grams.setdefault(gram, []).append(pos)
+        
+        tokens.sort()
+        self._tokens = [token for token, _ in tokens]
+        self._token_pos = np.array([pos for _, pos in tokens], dtype=np.int64)
+        self._grams = {gram: np.array(pos, dtype=np.int64) for gram, pos in grams.items()}
+
+    # Row positions whose tokens start with prefix
+    def _prefix_rows(self, prefix):
+        lo = bisect_left(self._tokens, prefix)
+        hi = bisect_left(self._tokens, prefix + "\uffff")
+        return np.unique(self._token_pos[lo:hi])
+
+    # Top-k labels for a query. Every query word matched as a prefix counts
+    # one point, trigram overlap adds up to one more for near misses
+    def search(self, query, k=SEARCH_LIMIT, active_only=False):
+        pool = self.active_labels if active_only else self.labels
+        words = _search_tokens(query or "")
+        if not words:
+            return pool[:k]
+        
+        score = np.zeros(len(self.labels))
+        for word in words:
+            score[self._prefix_rows(word)] += 1
+        
+        grams = _trigrams(words)
+        hits = [self._grams[g] for g in grams if g in self._grams]
+        if hits:
+            overlap = np.bincount(np.concatenate(hits), minlength=len(self.labels))
+            similarity = overlap / len(grams)
+            score += np.where(similarity >= SEARCH_MIN_SIMILARITY, similarity, 0)
+        
+        if active_only:
+            score[~self.active] = 0
+        
+        found = np.flatnonzero(score > 0)
+        if len(found) > k:
+            found = found[np.argpartition(-score[found], k - 1)[:k]]
+        found = found[np.lexsort((found, -score[found]))]
+        return [self.labels[i] for i in found]
+
+    # One-row frame for a selectbox label (keeps the column dtypes)
+    def select(self, borrowers, label):
+        return borrowers.iloc[[self.positions[label]]]
+
+@st.cache_resource(max_entries=4)
+def _cached_borrower_lookup(_borrowers, version):
+    return BorrowerLookup(_borrowers)
+
+# Lookup over borrowers with computed balances, built once per data version
+def get_borrower_lookup(borrowers, version):
+    if version is None:
+        return BorrowerLookup(borrowers)
+    return _cached_borrower_lookup(borrowers, version)
+
+# Get payment history for borrower (newest first), from the index when given
+def get_payment_history(borrower_id, payments, index=None):
+    if index is not None:
+        return index.slice(borrower_id).iloc[::-1].copy()
     if payments.empty:
         return pd.DataFrame()
     
@@ -225,7 +1059,7 @@ def get_payment_history(borrower_id, payments):
         history['total_paid'] = history['principal_paid'] + history['interest_paid']
     return history
 
-# Add a new payment
+# Add a new payment (amounts in RM)
 def add_payment(pid, principal, interest, payments):
     new_id = int(payments["payment_id"].max() + 1) if len(payments) > 0 else 1
     new_row = {
@@ -235,10 +1069,35 @@ def add_payment(pid, principal, interest, payments):
         "principal_paid": float(principal),
         "interest_paid": float(interest)
     }
-    payments = pd.concat([payments, pd.DataFrame([new_row])], ignore_index=True)
+    new_row = apply_schema(pd.DataFrame([new_row]), PAYMENT_SCHEMA)
+    payments = pd.concat([payments, new_row], ignore_index=True)
     return payments
 
-# Add new borrower
+# Add a reversal entry for a payment: same borrower, opposite amounts and
+# `reverses` set to its id. Reversals and payments already reversed are refused.
+def add_reversal(payment_id, payments):
+    matches = payments[payments["payment_id"] == payment_id] if not payments.empty else payments
+    if matches.empty:
+        raise ValueError(f"payment {payment_id} not found")
+    original = matches.iloc[0]
+    reverses = payments["reverses"] if "reverses" in payments.columns else pd.Series(pd.NA, index=payments.index, dtype="Int32")
+    if pd.notna(original.get("reverses")):
+        raise ValueError(f"payment {payment_id} is itself a reversal")
+    if (reverses == payment_id).any():
+        raise ValueError(f"payment {payment_id} has already been reversed")
+    
+    new_row = {
+        "payment_id": int(payments["payment_id"].max() + 1),
+        "borrower_id": int(original["borrower_id"]),
+        "date": datetime.now().strftime("%Y-%m-%d"),
+        "principal_paid": -int(original["principal_paid"] if pd.notna(original["principal_paid"]) else 0) / 100,
+        "interest_paid": -int(original["interest_paid"] if pd.notna(original["interest_paid"]) else 0) / 100,
+        "reverses": int(payment_id)
+    }
+    new_row = apply_schema(pd.DataFrame([new_row]), PAYMENT_SCHEMA)
+    return pd.concat([payments, new_row], ignore_index=True)
+
+# Add new borrower (amounts in RM)
 def add_borrower(borrowers, name, dept, phone, principal, interest_rate, start_date, months):
     new_id = int(borrowers["borrower_id"].max() + 1) if len(borrowers) > 0 else 1
     interest_total = principal * interest_rate
@@ -250,51 +1109,142 @@ def add_borrower(borrowers, name, dept, phone, principal, interest_rate, start_d
         "principal_total": float(principal),
         "interest_total": float(interest_total),
         "loan_start_date": str(start_date),
-        "months_to_pay": int(months),
-        "principal_remaining": float(principal),
-        "interest_remaining": float(interest_total)
+        "months_to_pay": int(months)
     }
-    borrowers = pd.concat([borrowers, pd.DataFrame([new_row])], ignore_index=True)
+    new_row = apply_schema(pd.DataFrame([new_row]), BORROWER_SCHEMA)
+    borrowers = pd.concat([borrowers, new_row], ignore_index=True)
+    # Concatenating categoricals with different categories falls back to object
+    if "department" in borrowers.columns:
+        borrowers["department"] = borrowers["department"].astype("category")
     return borrowers
 
-# Monthly summary with enhanced metrics
-def monthly_summary(payments, borrowers, month, year):
-    if payments.empty:
-        df = pd.DataFrame()
-    else:
-        payments_copy = payments.copy()
-        payments_copy['date'] = pd.to_datetime(payments_copy['date'], errors='coerce')
-        df = payments_copy[
-            (payments_copy["date"].dt.month == month) &
-            (payments_copy["date"].dt.year == year)
-        ]
-    
-    interest_income = df["interest_paid"].sum() if not df.empty else 0
-    principal_income = df["principal_paid"].sum() if not df.empty else 0
-    outstanding_interest = borrowers["interest_remaining"].sum() if not borrowers.empty else 0
-    outstanding_principal = borrowers["principal_remaining"].sum() if not borrowers.empty else 0
+# Payment totals (cents) and counts per (year, month) and per
+# (year, month, department), plus the outstanding balances, so a monthly
+# report is a dict lookup instead of a scan of the ledger. Built from the
+# per-borrower monthly totals of the ledger snapshots.
+class CollectionsCube:
+    def __init__(self, payments, borrowers):
+        self.months, self.departments = {}, {}
+        self.outstanding_principal = int(borrowers["principal_remaining"].sum()) if not borrowers.empty else 0
+        self.outstanding_interest = int(borrowers["interest_remaining"].sum()) if not borrowers.empty else 0
+        self.periods = []
+        if payments.empty:
+            return
+        
+        monthly = get_ledger_snapshots().monthly(payments).reset_index()
+        monthly = monthly[monthly["month"].notna()]
+        if borrowers.empty:
+            monthly["department"] = "-"
+        else:
+            monthly["department"] = monthly["borrower_id"].map(
+                borrowers.set_index("borrower_id")["department"]
+            ).astype("string").fillna("-")
+        monthly["year"], monthly["month"] = monthly["month"].dt.year, monthly["month"].dt.month
+        columns = ["principal_paid", "interest_paid", "payments"]
+        
+        totals = monthly.groupby(["year", "month"])[columns].sum()
+        for (year, month), row in zip(totals.index, totals.to_numpy(dtype=np.int64)):
+            self.months[(year, month)] = tuple(int(v) for v in row)
+        
+        by_department = monthly.groupby(["year", "month", "department"])[columns].sum()
+        for (year, month, department), row in zip(by_department.index, by_department.to_numpy(dtype=np.int64)):
+            self.departments.setdefault((year, month), {})[department] = tuple(int(v) for v in row)
+        self.periods = sorted(self.months)
     
-    return {
-        "interest_income": interest_income,
-        "principal_income": principal_income,
-        "outstanding_interest": outstanding_interest,
-        "outstanding_principal": outstanding_principal,
-        "profit": interest_income,
-        "total_collected": interest_income + principal_income,
-        "num_payments": len(df)
-    }
+    # Years with payments, oldest first
+    def years(self):
+        return sorted({year for year, _ in self.periods})
+
+    # Months of a year with payments
+    def months_of(self, year):
+        return [month for y, month in self.periods if y == year]
+
+    # Summary of one month (RM), in the shape monthly_summary has always returned
+    def summary(self, month, year):
+        principal, interest, count = self.months.get((year, month), (0, 0, 0))
+        interest_income = interest / 100
+        principal_income = principal / 100
+        return {
+            "interest_income": interest_income,
+            "principal_income": principal_income,
+            "outstanding_interest": self.outstanding_interest / 100,
+            "outstanding_principal": self.outstanding_principal / 100,
+            "profit": interest_income,
+            "total_collected": interest_income + principal_income,
+            "num_payments": count
+        }
+
+    # Collections of one month per department (RM)
+    def by_department(self, month, year):
+        rows = self.departments.get((year, month), {})
+        return pd.DataFrame(
+            [(dept, p / 100, i / 100, (p + i) / 100, n) for dept, (p, i, n) in sorted(rows.items())],
+            columns=["department", "principal_paid", "interest_paid", "total_paid", "num_payments"]
+        )
 
-# Get dashboard statistics
-def get_dashboard_stats(borrowers, payments):
+@st.cache_resource(max_entries=4)
+def _cached_collections_cube(_payments, _borrowers, version):
+    return CollectionsCube(_payments, _borrowers)
+
+# Collections cube built once per data version (the outstanding totals
+# depend on both sheets, so it is keyed on the combined version)
+def get_collections_cube(payments, borrowers, version):
+    if version is None:
+        return CollectionsCube(payments, borrowers)
+    return _cached_collections_cube(payments, borrowers, version)
+
+# Monthly summary with enhanced metrics, read from the collections cube
+def monthly_summary(payments, borrowers, month, year, cube=None):
+    if cube is None:
+        cube = CollectionsCube(payments, borrowers)
+    return cube.summary(month, year)
+
+# Borrowers whose balances stored in legacy columns disagree with the ones
+# derived from the ledger (cents). `stored` is Storage.stored_balances();
+# blank stored cells are not flagged
+def reconcile_balances(borrowers, stored):
+    columns = ["borrower_id", "name"] + [f"{col}_{kind}" for col in DERIVED_COLUMNS for kind in ("stored", "computed")] + ["difference"]
+    if stored is None or borrowers.empty:
+        return pd.DataFrame(columns=columns)
+    
+    report = borrowers[["borrower_id", "name"]].copy()
+    difference = 0
+    mismatch = pd.Series(False, index=borrowers.index)
+    for col in DERIVED_COLUMNS:
+        saved = borrowers["borrower_id"].map(stored[col]).astype("Int64")
+        report[f"{col}_stored"] = saved
+        report[f"{col}_computed"] = borrowers[col]
+        gap = (saved - borrowers[col]).fillna(0)
+        difference = difference + gap
+        mismatch |= (gap != 0).to_numpy(dtype=bool)
+    report["difference"] = difference
+    return report[mismatch].reset_index(drop=True)
+
+# Remove the legacy balance columns from the borrowers source
+def drop_stored_balances(store):
+    try:
+        store.drop_stored_balances()
+        _patch_data_caches(store, "borrowers", store.loaded("borrowers"))
+        return True
+    except Exception as e:
+        st.error(f"Error saving borrowers: {str(e)}")
+        return False
+
+# Get dashboard statistics. Uses the balances the caller already derived
+# with compute_balances, or derives them from the ledger snapshots (pass
+# `paid` to reuse cached totals)
+def get_dashboard_stats(borrowers, payments, paid=None):
+    if "principal_remaining" not in borrowers.columns:
+        borrowers = compute_balances(borrowers.copy(), payments, paid)
     total_loans = len(borrowers)
     active_loans = len(borrowers[borrowers['principal_remaining'] > 0])
-    total_principal_out = borrowers['principal_remaining'].sum()
-    total_interest_out = borrowers['interest_remaining'].sum()
+    total_principal_out = borrowers['principal_remaining'].sum() / 100
+    total_interest_out = borrowers['interest_remaining'].sum() / 100
     total_outstanding = total_principal_out + total_interest_out
     
     # Calculate collection rate
     if not borrowers.empty:
-        total_expected = borrowers['principal_total'].sum() + borrowers['interest_total'].sum()
+        total_expected = (borrowers['principal_total'].sum() + borrowers['interest_total'].sum()) / 100
         total_collected = total_expected - total_outstanding
         collection_rate = (total_collected / total_expected * 100) if total_expected > 0 else 0
     else:
@@ -310,3 +1260,116 @@ def get_dashboard_stats(borrowers, payments):
     }
 
 
+
+BALANCE_COLUMNS = [
+    "principal_disbursed", "interest_disbursed", "principal_collected", "interest_collected"
+]
+
+# Per-day sums (cents) of some amount columns, keyed by calendar day
+def _daily_totals(dates, amounts):
+    valid = dates.notna()
+    return amounts[valid].groupby(dates[valid].dt.normalize()).sum().astype(np.int64)
+
+# Daily portfolio history (cents): amounts disbursed and collected each day
+# and the running outstanding balances. The ledger is scanned once; after that
+# only payments appended since the last update are folded in, and the
+# running totals are re-accumulated over the (short) list of days
+class BalanceSeries:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.daily = pd.DataFrame(columns=BALANCE_COLUMNS, dtype=np.int64)
+        self.version = None
+        self.terms = None
+        self.payment_count = 0
+        self.payment_check = None
+
+    # Bring the series up to date with the current frames
+    def update(self, borrowers, payments, version=None):
+        with self.lock:
+            if version is not None and version == self.version:
+                return self.frame()
+            
+            terms = frame_version(borrowers[["borrower_id", "loan_start_date", "principal_total", "interest_total"]]) if not borrowers.empty else None
+            appended = (
+                terms == self.terms
+                and len(payments) >= self.payment_count
+                and self._payment_check(payments.iloc[:self.payment_count]) == self.payment_check
+            )
+            if appended:
+                self._add(self._payment_totals(payments.iloc[self.payment_count:]))
+            else:
+                self.daily = pd.DataFrame(columns=BALANCE_COLUMNS, dtype=np.int64)
+                if not borrowers.empty:
+                    disbursed = _daily_totals(borrowers["loan_start_date"], borrowers[["principal_total", "interest_total"]].fillna(0))
+                    disbursed.columns = ["principal_disbursed", "interest_disbursed"]
+                    self._add(disbursed)
+                self._add(self._payment_totals(payments))
+            
+            self.version = version
+            self.terms = terms
+            self.payment_count = len(payments)
+            self.payment_check = self._payment_check(payments)
+            return self.frame()
+
+    # Cheap fingerprint of the rows already folded in: the last payment_id
+    # plus column sums, so edits to earlier rows force a rebuild
+    def _payment_check(self, payments):
+        if payments.empty:
+            return None
+        dates = payments["date"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        return (
+            payments["payment_id"].iloc[-1],
+            int(payments["principal_paid"].fillna(0).sum()),
+            int(payments["interest_paid"].fillna(0).sum()),
+            int(dates[dates != np.iinfo(np.int64).min].sum())
+        )
+
+    def _payment_totals(self, payments):
+        if payments.empty:
+            return pd.DataFrame(columns=BALANCE_COLUMNS[2:], dtype=np.int64)
+        collected = _daily_totals(payments["date"], payments[["principal_paid", "interest_paid"]].fillna(0))
+        collected.columns = ["principal_collected", "interest_collected"]
+        return collected
+
+    # Add per-day amounts, widening the day range as needed
+    def _add(self, amounts):
+        if amounts.empty:
+            return
+        days = self.daily.index.union(amounts.index)
+        days = pd.date_range(days.min(), days.max(), freq="D")
+        self.daily = self.daily.reindex(days, fill_value=0).add(
+            amounts.reindex(columns=BALANCE_COLUMNS, fill_value=0), fill_value=0
+        ).astype(np.int64)
+
+    # Daily series up to today with running totals and outstanding balances
+    def frame(self):
+        if self.daily.empty:
+            return pd.DataFrame(columns=BALANCE_COLUMNS + ["principal_outstanding", "interest_outstanding", "collection_rate"])
+        today = pd.Timestamp(datetime.now()).normalize()
+        days = pd.date_range(self.daily.index.min(), max(self.daily.index.max(), today), freq="D")
+        series = self.daily.reindex(days, fill_value=0)
+        running = series.cumsum()
+        series["principal_outstanding"] = running["principal_disbursed"] - running["principal_collected"]
+        series["interest_outstanding"] = running["interest_disbursed"] - running["interest_collected"]
+        disbursed = running["principal_disbursed"] + running["interest_disbursed"]
+        collected = running["principal_collected"] + running["interest_collected"]
+        series["collection_rate"] = (collected / disbursed.where(disbursed > 0) * 100).fillna(0)
+        return series
+
+@st.cache_resource
+def _balance_series(sheet_url):
+    return BalanceSeries()
+
+# Daily balance series for a sheet, extended in place as payments arrive
+def get_balance_series(sheet_url, borrowers, payments, version=None):
+    return _balance_series(sheet_url).update(borrowers, payments, version)
+
+# Month-end view of a daily balance series: balances as of the last day,
+# disbursed and collected summed over the month
+def monthly_balance_series(series):
+    if series.empty:
+        return series
+    monthly = series[BALANCE_COLUMNS].resample("ME").sum()
+    for col in ("principal_outstanding", "interest_outstanding", "collection_rate"):
+        monthly[col] = series[col].resample("ME").last()
+    return monthly
@@ -0,0 +1,146 @@
+import os
+import sys
+import argparse
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Simulations per task; fixed so a seed gives the same result on any number of workers
+CHUNK_SIMS = 250
+# Upper bound on simulation x installment cells held in memory at once
+BATCH_CELLS = 4_000_000
+PERCENTILES = (5, 50, 95)
+
+_main_lock = threading.Lock()
+
+# Spawned workers re-import the parent's __main__ before running a task.
+# Under Streamlit that is app.py, which would load the data and start a
+# payment writer in every worker. So the workers are started while this
+# module stands in for __main__; they import it by name, under the
+# __main__ guard.
+@contextmanager
+def _simulation_as_main():
+    this = sys.modules[__name__]
+    with _main_lock:
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = this
+        try:
+            yield
+        finally:
+            if sys.modules["__main__"] is this:
+                sys.modules["__main__"] = main
+
+# One task: `sims` simulated portfolios, in batches small enough for memory.
+# Each installment is paid on time with its borrower's on-time probability,
+# otherwise it slips a geometric number of months; a borrower who defaults
+# pays nothing from that month on. Returns (sims, months) arrays of
+# principal and interest collected per month, in cents
+def _simulate_chunk(seed, sims, months, borrower, month, principal_due, interest_due,
+                    on_time, mean_delay, default_hazard):
+    rng = np.random.default_rng(seed)
+    principal = np.zeros((sims, months))
+    interest = np.zeros((sims, months))
+    if len(borrower) == 0:
+        return principal, interest
+    
+    # One uniform draw per installment decides both whether it is late and,
+    # rescaled onto the late range, by how much (inverse geometric CDF)
+    p_on_time = on_time[borrower]
+    with np.errstate(divide="ignore"):
+        log_stay = np.log1p(-1 / mean_delay[borrower])
+    hazard = np.clip(default_hazard, 1e-9, 1)
+    batch = max(1, BATCH_CELLS // len(borrower))
+    for start in range(0, sims, batch):
+        n = min(batch, sims - start)
+        draw = rng.random((n, len(borrower)))
+        late = draw >= p_on_time
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tail = (draw - p_on_time) / (1 - p_on_time)
+            slip = np.floor(np.log1p(-tail[late]) / np.broadcast_to(log_stay, late.shape)[late]) + 1
+        arrival = np.broadcast_to(month, late.shape).copy()
+        arrival[late] += np.nan_to_num(slip, nan=1, posinf=1).astype(np.int64)
+        default_month = (rng.geometric(hazard, (n, len(hazard))) - 1)[:, borrower]
+        paid = arrival < np.minimum(default_month, months)
+        
+        slot = (np.arange(n)[:, None] * months + arrival)[paid]
+        principal[start:start + n] = np.bincount(
+            slot, np.broadcast_to(principal_due, paid.shape)[paid], minlength=n * months
+        ).reshape(n, months)
+        interest[start:start + n] = np.bincount(
+            slot, np.broadcast_to(interest_due, paid.shape)[paid], minlength=n * months
+        ).reshape(n, months)
+    return principal, interest
+
+# Run n_sims simulated portfolios over a process pool. The portfolio is a
+# flat list of outstanding installments: borrower (position into the
+# per-borrower arrays), month (0 = this month) and the principal and interest
+# still owed on it (cents). on_time, mean_delay (months) and default_hazard
+# (per month) are per-borrower arrays. Returns cumulative interest collected
+# and outstanding principal per month as (n_sims, months) arrays
+def simulate(borrower, month, principal_due, interest_due, on_time, mean_delay, default_hazard,
+             months, outstanding_principal, n_sims=1000, seed=0, workers=None):
+    params = (
+        months,
+        np.asarray(borrower, dtype=np.int64),
+        np.asarray(month, dtype=np.int64),
+        np.asarray(principal_due, dtype=float),
+        np.asarray(interest_due, dtype=float),
+        np.asarray(on_time, dtype=float),
+        np.maximum(np.asarray(mean_delay, dtype=float), 1.0),
+        np.asarray(default_hazard, dtype=float)
+    )
+    sizes = [min(CHUNK_SIMS, n_sims - start) for start in range(0, n_sims, CHUNK_SIMS)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    
+    workers = workers or min(len(sizes), os.cpu_count() or 1)
+    if workers <= 1:
+        results = [_simulate_chunk(s, n, *params) for s, n in zip(seeds, sizes)]
+    else:
+        # Spawned (not forked) workers: the app process runs refresh threads.
+        # Workers are started as tasks are submitted.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            with _simulation_as_main():
+                futures = [pool.submit(_simulate_chunk, s, n, *params) for s, n in zip(seeds, sizes)]
+            results = [future.result() for future in futures]
+    
+    principal = np.concatenate([p for p, _ in results])
+    interest = np.concatenate([i for _, i in results])
+    return {
+        "interest_collected": np.cumsum(interest, axis=1),
+        "principal_outstanding": outstanding_principal - np.cumsum(principal, axis=1)
+    }
+
+# Percentile bands per month (RM) of simulate() output
+def summarize(result, months_index, percentiles=PERCENTILES):
+    frames = []
+    for measure, values in result.items():
+        bands = np.percentile(values, percentiles, axis=0) / 100
+        for pct, band in zip(percentiles, bands):
+            frames.append(pd.DataFrame({"month": months_index, "measure": measure, "percentile": pct, "value": band}))
+    return pd.concat(frames, ignore_index=True)
+
+# Command line: python simulation.py --sims 5000 --months 12 --seed 7
+# Reads the configured store (LOAN_STORAGE_BACKEND / LOAN_STORAGE_PATH or secrets)
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo portfolio simulation")
+    parser.add_argument("--sims", type=int, default=1000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--sheet-url", default=os.environ.get("LOAN_SHEET_URL", ""))
+    args = parser.parse_args()
+    
+    from backend import get_storage, compute_balances, run_portfolio_simulation
+    borrowers, payments = get_storage(args.sheet_url).load()
+    borrowers = compute_balances(borrowers, payments)
+    summary = run_portfolio_simulation(
+        borrowers, payments, args.months, args.sims, args.seed, workers=args.workers
+    )
+    print(summary.pivot_table(index="month", columns=["measure", "percentile"], values="value").round(2).to_string())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,886 @@
+import os
+import re
+import json
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import streamlit as st
+import gspread
+import pandas as pd
+import numpy as np
+from google.oauth2.service_account import Credentials
+
+# Declared column types for both sheets. Money is held as integer cents
+# ("cents", Int64) and written back in RM; nullable types turn bad cells into <NA>.
+BORROWER_SCHEMA = {
+    "borrower_id": "Int32",
+    "name": "string",
+    "department": "category",
+    "phone": "string",
+    "principal_total": "cents",
+    "interest_total": "cents",
+    "loan_start_date": "datetime",
+    "months_to_pay": "Int16"
+}
+# Balances are derived from the payments on read and no longer written.
+# Sheets saved before that still have these columns; they are loaded only
+# to reconcile them and are left as they are until dropped.
+DERIVED_BORROWER_SCHEMA = {
+    "principal_remaining": "cents",
+    "interest_remaining": "cents"
+}
+DERIVED_COLUMNS = list(DERIVED_BORROWER_SCHEMA)
+# The payments sheet is an append-only ledger: a payment is undone by a
+# reversal entry with the opposite amounts whose `reverses` holds the
+# payment_id it cancels (blank on ordinary payments)
+PAYMENT_SCHEMA = {
+    "payment_id": "Int32",
+    "borrower_id": "Int32",
+    "date": "datetime",
+    "principal_paid": "cents",
+    "interest_paid": "cents",
+    "reverses": "Int32"
+}
+BORROWER_COLUMNS = list(BORROWER_SCHEMA)
+PAYMENT_COLUMNS = list(PAYMENT_SCHEMA)
+MONEY_COLUMNS = {
+    col for schema in (BORROWER_SCHEMA, DERIVED_BORROWER_SCHEMA, PAYMENT_SCHEMA)
+    for col, kind in schema.items() if kind == "cents"
+}
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+# Convert raw sheet values to the declared types
+def apply_schema(df, schema):
+    for col, kind in schema.items():
+        if col not in df.columns:
+            continue
+        if kind == "cents":
+            df[col] = pd.to_numeric(df[col], errors="coerce").mul(100).round().astype("Int64")
+        elif kind == "datetime":
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        elif kind.startswith("Int"):
+            df[col] = pd.to_numeric(df[col], errors="coerce").round().astype(kind)
+        elif kind == "category":
+            df[col] = df[col].replace("", None).astype("category")
+        else:
+            df[col] = df[col].astype(kind)
+    return df
+
+# Per-column dtype and memory use in bytes
+def memory_report(df):
+    return pd.DataFrame({
+        "dtype": df.dtypes.astype(str),
+        "bytes": df.memory_usage(deep=True, index=False)
+    })
+
+# Convert a cell to a plain Python value; dates are stored as YYYY-MM-DD
+def _cell(value, blank=""):
+    # NaT is a datetime too, so blanks are checked first
+    if not isinstance(value, str) and pd.isna(value):
+        return blank
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, np.generic):
+        value = value.item()
+    return value
+
+# Rows as stored in the sheet: money back in RM, dates as text
+def _to_rows(df, blank=""):
+    money = [col for col in df.columns if col in MONEY_COLUMNS]
+    if money:
+        df = df.copy()
+        for col in money:
+            df[col] = df[col].astype("Float64") / 100
+    return [[_cell(v, blank) for v in row] for row in df.astype(object).values.tolist()]
+
+# Build a frame from a raw value grid (header row first). The API trims
+# trailing blank cells, so short rows are padded; blank rows are kept so
+# positions still line up with sheet rows.
+def _grid_to_frame(values):
+    if not values:
+        return pd.DataFrame()
+    header = values[0]
+    rows = [row + [""] * (len(header) - len(row)) for row in values[1:]]
+    return pd.DataFrame([row[:len(header)] for row in rows], columns=header)
+
+SCHEMAS = {"borrowers": {**BORROWER_SCHEMA, **DERIVED_BORROWER_SCHEMA}, "payments": PAYMENT_SCHEMA}
+
+# Raised by a save when the source changed since it was last loaded
+class WriteConflict(Exception):
+    pass
+
+# Convert data types
+def _convert_types(borrowers, payments):
+    return apply_schema(borrowers, SCHEMAS["borrowers"]), apply_schema(payments, PAYMENT_SCHEMA)
+
+# Borrowers as callers see them: stored balance columns left out
+def _source_borrowers(df):
+    return df.drop(columns=DERIVED_COLUMNS, errors="ignore")
+
+# Payments as callers see them: columns added to the schema after the sheet
+# was created are present (blank) until the first save adds them to it
+def _full_payments(df):
+    if df.columns.empty:
+        return df
+    df = df.copy()
+    for col, kind in PAYMENT_SCHEMA.items():
+        if col not in df.columns:
+            df[col] = pd.array([pd.NA] * len(df), dtype=kind)
+    return df
+
+
+# Common storage interface: load, append payments, upsert borrowers, snapshot.
+# The base class remembers what was last loaded so saves only write what changed.
+# `lock` serializes loads and saves, which may come from background threads.
+# Borrowers are remembered as stored, legacy balance columns included, but
+# loaded and saved without them.
+class Storage:
+    def __init__(self):
+        self._snapshots = {}
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            borrowers, payments = _convert_types(*self._read())
+            self._remember("borrowers", borrowers)
+            self._remember("payments", payments)
+            return _source_borrowers(borrowers), _full_payments(payments)
+
+    # Copy of the frame last loaded or saved, or None before the first load
+    def loaded(self, name):
+        snapshot = self._snapshots.get(name)
+        if not snapshot:
+            return None
+        return _source_borrowers(snapshot["frame"]) if name == "borrowers" else _full_payments(snapshot["frame"])
+
+    # Balances (cents) still stored in legacy borrower columns, by borrower_id,
+    # or None when the source has no such columns
+    def stored_balances(self):
+        snapshot = self._snapshots.get("borrowers")
+        if not snapshot or not set(DERIVED_COLUMNS) <= set(snapshot["header"]):
+            return None
+        frame = snapshot["frame"].dropna(subset=["borrower_id"]).drop_duplicates("borrower_id")
+        return frame.set_index("borrower_id")[DERIVED_COLUMNS]
+
+    # Frames served from a disk snapshot were never loaded through this store,
+    # so there is nothing safe to diff them against
+    def _check_loaded(self):
+        if not self._snapshots:
+            raise RuntimeError("data has not been loaded from the source yet, please try again")
+
+    # Append new payments. The ledger is append-only: edited or removed rows
+    # are refused (record a reversal instead); only an empty source is written whole
+    def save_payments(self, df):
+        with self.lock, self._transaction():
+            self._check_loaded()
+            self._check_unchanged("payments")
+            self._extend_header("payments", df)
+            changed, added = self._diff("payments", df)
+            if changed is None and not self._snapshots["payments"]["header"]:
+                self.replace_payments(df)
+            elif changed is None or not changed.empty:
+                raise ValueError("payments cannot be edited or removed; record a reversal instead")
+            elif not added.empty:
+                self.append_payments(added)
+            self._remember("payments", df)
+
+    # Upsert changed and new borrowers; rewrite only when the columns changed
+    def save_borrowers(self, df):
+        with self.lock, self._transaction():
+            self._check_loaded()
+            self._check_unchanged("borrowers")
+            df = self._as_stored(df)
+            changed, added = self._diff("borrowers", df)
+            if changed is None:
+                self.replace_borrowers(df)
+            elif not changed.empty or not added.empty:
+                self.upsert_borrowers(pd.concat([changed, added]))
+            self._remember("borrowers", df)
+
+    # Add columns the frame has beyond the end of the source header, leaving
+    # them blank on the rows already stored
+    def _extend_header(self, name, df):
+        snapshot = self._snapshots[name]
+        header, columns = snapshot["header"], df.columns.tolist()
+        if not header or len(columns) <= len(header) or columns[:len(header)] != header:
+            return
+        self.add_columns(name, header, columns[len(header):])
+        self._remember(name, snapshot["frame"].reindex(columns=columns))
+
+    # Rewrite the borrowers without the legacy balance columns
+    def drop_stored_balances(self):
+        with self.lock, self._transaction():
+            self._check_loaded()
+            self._check_unchanged("borrowers")
+            df = self.loaded("borrowers")
+            self.replace_borrowers(df)
+            self._remember("borrowers", df)
+
+    # Lay a borrowers frame out like the source: computed balances dropped and
+    # legacy stored ones carried over unchanged, so saving never rewrites them
+    def _as_stored(self, df):
+        df = _source_borrowers(df)
+        header = self._snapshots["borrowers"]["header"]
+        if not set(DERIVED_COLUMNS) <= set(header):
+            return df
+        stored = self.stored_balances()
+        df = df.copy()
+        for col in DERIVED_COLUMNS:
+            df[col] = df["borrower_id"].map(stored[col]).astype("Int64")
+        return df.reindex(columns=header) if set(header) == set(df.columns) else df
+
+    # Copy the current contents into a local SQLite file. Rows are typed first,
+    # since the store's writers expect cents and write money back in RM.
+    def snapshot(self, path):
+        borrowers, payments = _convert_types(*self._read())
+        borrowers = _source_borrowers(borrowers)
+        target = SQLiteStorage(path)
+        target.replace_borrowers(borrowers)
+        target.replace_payments(payments)
+        return target
+
+    def _remember(self, name, df):
+        self._snapshots[name] = {
+            "header": df.columns.tolist(),
+            "rows": _to_rows(df),
+            "frame": df.copy()
+        }
+
+    # Split a frame into rows edited since the load and rows added after it.
+    # Returns (None, None) when the frame no longer lines up with what was loaded.
+    def _diff(self, name, df):
+        snapshot = self._snapshots.get(name)
+        if not snapshot or not snapshot["header"] or snapshot["header"] != df.columns.tolist():
+            return None, None
+        rows = _to_rows(df)
+        loaded = len(snapshot["rows"])
+        if len(rows) < loaded:
+            return None, None
+        changed = [i for i in range(loaded) if rows[i] != snapshot["rows"][i]]
+        return df.iloc[changed], df.iloc[loaded:]
+
+    # Optimistic concurrency: before writing, compare the source with what was
+    # last loaded. Borrowers are compared in full; for the append-only ledger
+    # the last known row must still be the last row.
+    def _check_unchanged(self, name):
+        snapshot = self._snapshots[name]
+        if not snapshot["header"]:
+            return
+        start = 0 if name == "borrowers" else max(len(snapshot["rows"]) - 1, 0)
+        if self._source_rows(name, snapshot["header"], start) != snapshot["rows"][start:]:
+            raise WriteConflict(f"{name} were changed by someone else; reload and try again")
+
+    # Saves run their check and their writes inside this; stores that can keep
+    # other writers out across both (SQLite) override it
+    def _transaction(self):
+        return nullcontext()
+
+    def _read(self):
+        raise NotImplementedError
+
+    # Typed rows of a table from data row `start` (0-based) to the end, or None
+    # when its header no longer matches
+    def _source_rows(self, name, header, start):
+        raise NotImplementedError
+
+    def append_payments(self, df):
+        raise NotImplementedError
+
+    def upsert_borrowers(self, df):
+        raise NotImplementedError
+
+    def add_columns(self, name, header, columns):
+        raise NotImplementedError
+
+    def replace_payments(self, df):
+        raise NotImplementedError
+
+    def replace_borrowers(self, df):
+        raise NotImplementedError
+
+
+# Raised instead of calling the API while the circuit breaker is open
+class SheetsUnavailable(Exception):
+    pass
+
+# Every Sheets request goes through one throttle per process: a token bucket
+# sized to the per-minute quota, retries with jittered exponential backoff on
+# 429 and 5xx, and a circuit breaker. When a request still fails after all
+# retries the breaker opens and calls fail fast for BREAKER_SECONDS, so the
+# app keeps serving cached frames instead of queueing more doomed requests.
+class SheetsThrottle:
+    MAX_RETRIES = 5
+    BASE_DELAY = 1
+    MAX_DELAY = 32
+    BREAKER_SECONDS = 60
+
+    def __init__(self, per_minute=60):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.open_until = 0
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "breaker_trips": 0}
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Take one token, sleeping until the bucket has one
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def is_open(self):
+        return time.time() < self.open_until
+
+    def call(self, fn, *args, **kwargs):
+        if self.is_open():
+            raise SheetsUnavailable(
+                f"Google Sheets is rate limited; showing cached data (retrying in {int(self.open_until - time.time())}s)"
+            )
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.acquire()
+            self.stats["calls"] += 1
+            try:
+                return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                if status != 429 and status < 500:
+                    raise
+                if status == 429:
+                    self.stats["throttled"] += 1
+                if attempt == self.MAX_RETRIES:
+                    self.open_until = time.time() + self.BREAKER_SECONDS
+                    self.stats["breaker_trips"] += 1
+                    raise
+                self.stats["retries"] += 1
+                time.sleep(random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt)))
+
+# Sized by `sheets_quota` in [storage] (or LOAN_STORAGE_SHEETS_QUOTA), requests per minute
+@st.cache_resource
+def get_sheets_throttle():
+    return SheetsThrottle(int(_storage_setting("sheets_quota", 60)))
+
+# How often this process has authorized and opened the spreadsheet
+client_stats = {"authorizations": 0, "spreadsheet_opens": 0}
+
+def get_client_stats():
+    return dict(client_stats)
+
+# Connect to Google Sheets using Streamlit Secrets. The client is shared by all
+# reruns and sessions; its AuthorizedSession refreshes the access token itself
+# when it expires, so authorizing again is only needed after a restart.
+@st.cache_resource
+def get_gsheet_client():
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    creds_dict = st.secrets["gcp_service_account"]
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+    client = gspread.authorize(creds)
+    client_stats["authorizations"] += 1
+    return client
+
+
+# Google Sheets store: one worksheet per table, header in row 1
+class SheetsStorage(Storage):
+    # Edits in the middle of the payments ledger are invisible to a tail read,
+    # so re-read the whole sheet at least this often
+    FULL_RELOAD_SECONDS = 600
+
+    def __init__(self, sheet_url):
+        super().__init__()
+        self.sheet_url = sheet_url
+        self.throttle = get_sheets_throttle()
+        self._full_loaded_at = 0
+        self._spreadsheet = None
+        self.borrowers_ws = None
+        self.payments_ws = None
+
+    # Open the spreadsheet and look up the worksheets once, then reuse the handles
+    def _open(self):
+        if self._spreadsheet is None:
+            self._spreadsheet = self.throttle.call(get_gsheet_client().open_by_url, self.sheet_url)
+            client_stats["spreadsheet_opens"] += 1
+        if self.borrowers_ws is None or self.payments_ws is None:
+            worksheets = {ws.title: ws for ws in self.throttle.call(self._spreadsheet.worksheets)}
+            self.borrowers_ws = worksheets["borrowers"]
+            self.payments_ws = worksheets["payments"]
+
+    # Drop the handles so the next call re-opens the spreadsheet
+    def reset(self):
+        self._spreadsheet = None
+        self.borrowers_ws = None
+        self.payments_ws = None
+
+    # Read only the payment rows appended since the last load when possible
+    def load(self):
+        with self.lock:
+            if time.time() - self._full_loaded_at < self.FULL_RELOAD_SECONDS:
+                result = self._load_tail()
+                if result is not None:
+                    return result
+            result = super().load()
+            self._full_loaded_at = time.time()
+            return result
+
+    # Fetch all borrowers plus the payments header and everything from the last
+    # known payment row down. Returns None when the last known row no longer
+    # matches (rows were deleted or moved) so the caller does a full reload.
+    def _load_tail(self):
+        snapshot = self._snapshots.get("payments")
+        if not snapshot or not snapshot["header"] or "borrowers" not in self._snapshots:
+            return None
+        header = snapshot["header"]
+        loaded = len(snapshot["rows"])
+        last_col = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, len(header)))
+        start = loaded + 1 if loaded else 2
+        borrower_grid, header_grid, tail_grid = self._batch_get([
+            "'borrowers'",
+            f"'payments'!A1:{last_col}1",
+            f"'payments'!A{start}:{last_col}"
+        ])
+        if not header_grid or header_grid[0] != header:
+            return None
+        
+        _, tail = _convert_types(pd.DataFrame(), _grid_to_frame([header] + tail_grid))
+        if loaded:
+            if tail.empty or _to_rows(tail.iloc[:1])[0] != snapshot["rows"][-1]:
+                return None
+            tail = tail.iloc[1:]
+        
+        borrowers, _ = _convert_types(_grid_to_frame(borrower_grid), pd.DataFrame())
+        payments = snapshot["frame"]
+        if not tail.empty:
+            payments = pd.concat([payments, tail], ignore_index=True) if loaded else tail.reset_index(drop=True)
+        self._remember("borrowers", borrowers)
+        self._remember("payments", payments)
+        return _source_borrowers(borrowers), _full_payments(payments)
+
+    # Fetch both tabs in a single values:batchGet request
+    def _read(self):
+        borrowers, payments = self._batch_get(["'borrowers'", "'payments'"])
+        return _grid_to_frame(borrowers), _grid_to_frame(payments)
+
+    def _source_rows(self, name, header, start):
+        last_col = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, len(header)))
+        header_grid, grid = self._batch_get([f"'{name}'!A1:{last_col}1", f"'{name}'!A{start + 2}:{last_col}"])
+        if not header_grid or header_grid[0] != header:
+            return None
+        frame = _grid_to_frame([header] + grid)
+        return _to_rows(apply_schema(frame, SCHEMAS[name]))
+
+    def _batch_get(self, ranges):
+        self._open()
+        try:
+            response = self.throttle.call(
+                self._spreadsheet.values_batch_get,
+                ranges,
+                params={
+                    "valueRenderOption": "UNFORMATTED_VALUE",
+                    "dateTimeRenderOption": "FORMATTED_STRING"
+                }
+            )
+        except gspread.exceptions.APIError as e:
+            # A renamed or deleted tab invalidates the cached handles
+            if e.response.status_code in (400, 404):
+                self.reset()
+            raise
+        return [r.get("values", []) for r in response["valueRanges"]]
+
+    # One append request for all new rows
+    def append_payments(self, df):
+        self.throttle.call(self.payments_ws.append_rows, _to_rows(df))
+
+    # One batch_update for the changed cells, one append for new borrowers
+    def upsert_borrowers(self, df):
+        snapshot = self._snapshots["borrowers"]
+        id_col = snapshot["header"].index("borrower_id")
+        positions = {row[id_col]: i for i, row in enumerate(snapshot["rows"])}
+        updates, appends = [], []
+        for row in _to_rows(df[snapshot["header"]]):
+            i = positions.get(row[id_col])
+            if i is None:
+                appends.append(row)
+                continue
+            for j, (before, after) in enumerate(zip(snapshot["rows"][i], row)):
+                if before != after:
+                    updates.append({
+                        "range": gspread.utils.rowcol_to_a1(i + 2, j + 1),
+                        "values": [[after]]
+                    })
+        if updates:
+            self.throttle.call(self.borrowers_ws.batch_update, updates)
+        if appends:
+            self.throttle.call(self.borrowers_ws.append_rows, appends)
+
+    # Write the new header cells after the existing ones in row 1
+    def add_columns(self, name, header, columns):
+        self._open()
+        worksheet = self.borrowers_ws if name == "borrowers" else self.payments_ws
+        first = gspread.utils.rowcol_to_a1(1, len(header) + 1)
+        last = gspread.utils.rowcol_to_a1(1, len(header) + len(columns))
+        self.throttle.call(worksheet.update, [columns], range_name=f"{first}:{last}")
+
+    def replace_payments(self, df):
+        self._rewrite(self.payments_ws, df)
+
+    def replace_borrowers(self, df):
+        self._rewrite(self.borrowers_ws, df)
+
+    def _rewrite(self, worksheet, df):
+        self.throttle.call(worksheet.clear)
+        self.throttle.call(worksheet.update, [df.columns.values.tolist()] + _to_rows(df))
+
+
+# Local SQLite store with the same tables, indexed for per-borrower and per-date reads
+class SQLiteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS borrowers (
+            borrower_id INTEGER PRIMARY KEY,
+            name TEXT,
+            department TEXT,
+            phone TEXT,
+            principal_total REAL,
+            interest_total REAL,
+            loan_start_date TEXT,
+            months_to_pay INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id INTEGER PRIMARY KEY,
+            borrower_id INTEGER,
+            date TEXT,
+            principal_paid REAL,
+            interest_paid REAL,
+            reverses INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_payments_borrower_date ON payments (borrower_id, date);
+        CREATE INDEX IF NOT EXISTS idx_payments_date ON payments (date);
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+
+    # One write transaction; BEGIN IMMEDIATE takes the database write lock up
+    # front, so no other process can write between a save's check and its
+    # writes. Nested calls join the outer transaction.
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+            finally:
+                self._depth = 0
+
+    def _read(self):
+        with self._lock:
+            borrowers = pd.read_sql_query("SELECT * FROM borrowers ORDER BY borrower_id", self._conn)
+            payments = pd.read_sql_query("SELECT * FROM payments ORDER BY payment_id", self._conn)
+        return borrowers, payments
+
+    def _source_rows(self, name, header, start):
+        order = "borrower_id" if name == "borrowers" else "payment_id"
+        with self._lock:
+            df = pd.read_sql_query(
+                f"SELECT * FROM {name} ORDER BY {order} LIMIT -1 OFFSET ?", self._conn, params=(start,)
+            )
+        if df.columns.tolist() != header:
+            return None
+        return _to_rows(apply_schema(df, SCHEMAS[name]))
+
+    def append_payments(self, df):
+        self._insert("payments", PAYMENT_COLUMNS, df, "INSERT")
+
+    # Changed borrowers are updated and new ones inserted, so a new id someone
+    # else took meanwhile raises WriteConflict instead of replacing their row.
+    # Files created before balances were derived also have the legacy columns.
+    def upsert_borrowers(self, df):
+        snapshot = self._snapshots["borrowers"]
+        id_col = snapshot["header"].index("borrower_id")
+        known = df["borrower_id"].isin({row[id_col] for row in snapshot["rows"]}).to_numpy(dtype=bool)
+        columns = self._columns("borrowers")
+        rows = _to_rows(df[known].reindex(columns=columns), blank=None)
+        assignments = ", ".join(f"{col} = ?" for col in columns)
+        with self._transaction():
+            self._conn.executemany(
+                f"UPDATE borrowers SET {assignments} WHERE borrower_id = ?",
+                [row + [row[columns.index("borrower_id")]] for row in rows]
+            )
+            self._insert("borrowers", columns, df[~known], "INSERT")
+
+    def replace_payments(self, df):
+        self._insert("payments", PAYMENT_COLUMNS, df, "INSERT", replace=True)
+
+    def add_columns(self, name, header, columns):
+        types = {"cents": "REAL", "datetime": "TEXT", "string": "TEXT", "category": "TEXT"}
+        with self._transaction():
+            for col in columns:
+                kind = SCHEMAS[name].get(col, "string")
+                self._conn.execute(f"ALTER TABLE {name} ADD COLUMN {col} {types.get(kind, 'INTEGER')}")
+
+    def replace_borrowers(self, df):
+        columns = self._columns("borrowers")
+        with self._transaction():
+            for col in DERIVED_COLUMNS:
+                if col in columns and col not in df.columns:
+                    self._conn.execute(f"ALTER TABLE borrowers DROP COLUMN {col}")
+        self._insert("borrowers", self._columns("borrowers"), df, "INSERT", replace=True)
+
+    def _columns(self, table):
+        with self._lock:
+            return [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+
+    # The file is already local, so use SQLite's online backup instead of a re-read
+    def snapshot(self, path):
+        target = SQLiteStorage(path)
+        with self._lock:
+            self._conn.backup(target._conn)
+        return target
+
+    def _insert(self, table, columns, df, verb, replace=False):
+        rows = _to_rows(df.reindex(columns=columns), blank=None)
+        placeholders = ", ".join("?" for _ in columns)
+        try:
+            with self._transaction():
+                if replace:
+                    self._conn.execute(f"DELETE FROM {table}")
+                self._conn.executemany(
+                    f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows
+                )
+        except sqlite3.IntegrityError as e:
+            # Another writer took the same id between the check and the insert
+            raise WriteConflict(f"{table}: {e}")
+
+
+# Durable local queue of payments recorded but not yet written to the store.
+# Rows are kept in SQLite (money in cents) in the order they were queued and
+# deleted only once the store has them.
+class PaymentOutbox:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id INTEGER,
+            borrower_id INTEGER,
+            date TEXT,
+            principal_paid INTEGER,
+            interest_paid INTEGER,
+            queued_at REAL,
+            reverses INTEGER
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+        # Outboxes created before reversals existed
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")]
+        if "reverses" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN reverses INTEGER")
+
+    # Queue one typed payment row; committed before this returns
+    def put(self, row):
+        reverses = row.get("reverses")
+        values = (
+            int(row["payment_id"]), int(row["borrower_id"]),
+            pd.Timestamp(row["date"]).strftime("%Y-%m-%d %H:%M:%S"),
+            int(row["principal_paid"]), int(row["interest_paid"]), time.time(),
+            None if pd.isna(reverses) else int(reverses)
+        )
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (payment_id, borrower_id, date, principal_paid, interest_paid, queued_at, reverses) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", values
+            )
+        return cursor.lastrowid
+
+    # Queued payments in queue order, typed like the payments frame plus `seq`
+    def pending(self):
+        with self._lock:
+            df = pd.read_sql_query("SELECT * FROM outbox ORDER BY seq", self._conn)
+        df["date"] = pd.to_datetime(df["date"])
+        for col, kind in PAYMENT_SCHEMA.items():
+            if kind.startswith("Int"):
+                df[col] = df[col].astype(kind)
+            elif kind == "cents":
+                df[col] = df[col].astype("Int64")
+        return df
+
+    # Record the ids a flush is about to write, before it writes them
+    def assign_ids(self, seqs, payment_ids):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE outbox SET payment_id = ? WHERE seq = ?",
+                [(int(p), int(s)) for s, p in zip(seqs, payment_ids)]
+            )
+
+    def done(self, seqs):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE seq = ?", [(int(s),) for s in seqs])
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+# Fingerprints of the typed frames, used to tag snapshots and key derived caches
+def frame_version(df):
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(repr(df.columns.tolist()).encode())
+    if not df.empty:
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def data_version(borrowers, payments, versions=None):
+    versions = versions or {"borrowers": frame_version(borrowers), "payments": frame_version(payments)}
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{versions['borrowers']}:{versions['payments']}".encode())
+    return digest.hexdigest()
+
+# Parquet needs one type per column; mixed object columns (e.g. phone) become text
+def _parquet_safe(df):
+    out = df.copy()
+    for col in out.columns:
+        if out[col].dtype == object:
+            out[col] = out[col].where(out[col].isna(), out[col].astype(str))
+    return out
+
+# Bump when the typed frame layout changes so older snapshots are ignored
+SNAPSHOT_SCHEMA = 4
+
+def _snapshot_dir():
+    return _storage_setting("snapshot_dir", ".loan_cache")
+
+# Persist the typed frames as Parquet files named after their version. The
+# meta file is replaced last, so a reader never sees a half-written snapshot.
+def write_disk_snapshot(borrowers, payments, version=None):
+    version = version or data_version(borrowers, payments)
+    folder = _snapshot_dir()
+    os.makedirs(folder, exist_ok=True)
+    meta_path = os.path.join(folder, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+            if meta.get("version") == version and meta.get("schema") == SNAPSHOT_SCHEMA:
+                return version
+    
+    files = {}
+    for name, df in (("borrowers", borrowers), ("payments", payments)):
+        files[name] = f"{name}-{version}.parquet"
+        _parquet_safe(df).to_parquet(os.path.join(folder, files[name]), index=False)
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "schema": SNAPSHOT_SCHEMA, "saved_at": time.time(), "files": files}, f)
+    os.replace(tmp_path, meta_path)
+    
+    for name in os.listdir(folder):
+        if name.endswith(".parquet") and name not in files.values():
+            os.remove(os.path.join(folder, name))
+    return version
+
+# Read the last snapshot written by write_disk_snapshot, or None
+def read_disk_snapshot():
+    folder = _snapshot_dir()
+    try:
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("schema") != SNAPSHOT_SCHEMA:
+            return None
+        borrowers = pd.read_parquet(os.path.join(folder, meta["files"]["borrowers"]))
+        payments = pd.read_parquet(os.path.join(folder, meta["files"]["payments"]))
+    except (OSError, ValueError, KeyError):
+        return None
+    return borrowers, payments, meta
+
+
+# Per-borrower monthly payment totals folded from the ledger, kept in their
+# own folder under the snapshot cache with a meta file describing what they
+# cover. As with the frames, the meta file is replaced last.
+def write_balance_snapshot(balances, meta):
+    folder = os.path.join(_snapshot_dir(), "balances")
+    os.makedirs(folder, exist_ok=True)
+    file = f"balances-{time.time_ns()}.parquet"
+    balances.to_parquet(os.path.join(folder, file))
+    tmp_path = os.path.join(folder, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({**meta, "schema": SNAPSHOT_SCHEMA, "saved_at": time.time(), "file": file}, f)
+    os.replace(tmp_path, os.path.join(folder, "meta.json"))
+    
+    for name in os.listdir(folder):
+        if name.endswith(".parquet") and name != file:
+            os.remove(os.path.join(folder, name))
+
+# Read the balances written by write_balance_snapshot as (frame, meta), or None
+def read_balance_snapshot():
+    folder = os.path.join(_snapshot_dir(), "balances")
+    try:
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("schema") != SNAPSHOT_SCHEMA:
+            return None
+        balances = pd.read_parquet(os.path.join(folder, meta["file"]))
+    except (OSError, ValueError, KeyError):
+        return None
+    return balances, meta
+
+
+# Read a storage setting from the environment, then the [storage] secrets section
+def _storage_setting(key, default):
+    value = os.environ.get(f"LOAN_STORAGE_{key.upper()}")
+    if value:
+        return value
+    try:
+        return st.secrets["storage"][key]
+    except Exception:
+        return default
+
+# The payment outbox, kept outside the snapshot cache folder since it holds
+# data the store has not seen yet (`outbox` in [storage] or LOAN_STORAGE_OUTBOX)
+@st.cache_resource
+def get_outbox():
+    return PaymentOutbox(_storage_setting("outbox", "loan_outbox.db"))
+
+# One store per process, selected by configuration (backend = "sheets" or "sqlite")
+@st.cache_resource
+def get_storage(sheet_url):
+    backend = _storage_setting("backend", "sheets").lower()
+    if backend == "sqlite":
+        return SQLiteStorage(_storage_setting("path", "loan_data.db"))
+    if backend == "sheets":
+        return SheetsStorage(sheet_url)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SQLiteStorage, PAYMENT_SCHEMA, apply_schema, _grid_to_frame, _to_rows
+
+
+# A blank or unparseable date becomes NaT, which must load and write back as blank
+def test_load_with_blank_payment_date(tmp_path):
+    store = SQLiteStorage(str(tmp_path / "loan.db"))
+    with store._conn:
+        store._conn.execute(
+            "INSERT INTO payments (payment_id, borrower_id, date, principal_paid, interest_paid) "
+            "VALUES (1, 1, '2024-02-01', 10, 1), (2, 1, '', 5, 0)"
+        )
+
+    _, payments = store.load()
+    assert payments["date"].isna().tolist() == [False, True]
+    assert store._snapshots["payments"]["rows"][1][2] == ""
+
+
+def test_rows_of_grid_with_blank_row():
+    grid = [
+        ["payment_id", "borrower_id", "date", "principal_paid", "interest_paid"],
+        [1, 1, "2024-02-01", 10, 1],
+        []
+    ]
+    payments = apply_schema(_grid_to_frame(grid), PAYMENT_SCHEMA)
+
+    rows = _to_rows(payments)
+    assert rows[0] == [1, 1, "2024-02-01", 10.0, 1.0]
+    assert rows[1] == ["", "", "", "", ""]
+    assert pd.isna(payments["date"].iloc[1])